@@ -1,12 +1,16 @@
 import asyncio
+import functools
+import hashlib
 import logging
-import traceback
+import tempfile
+import time
 import re
+from collections import OrderedDict
+from contextlib import asynccontextmanager, suppress
 from datetime import datetime
 from io import BytesIO
-import base64
 
-from aiogram import Bot, Dispatcher, F, Router
+from aiogram import BaseMiddleware, Bot, Dispatcher, F, Router
 from aiogram.types import (
     Message, 
     CallbackQuery,
@@ -17,11 +21,12 @@ from aiogram.types import (
 )
 
 from aiogram.filters import Command, CommandStart
-from aiogram.fsm.storage.memory import MemoryStorage
 from aiogram.enums import ParseMode, ChatAction
 from aiogram.client.default import DefaultBotProperties
+from aiogram.client.session.aiohttp import AiohttpSession
 from aiogram.utils.backoff import BackoffConfig
-from aiogram.exceptions import TelegramBadRequest
+from aiogram.exceptions import TelegramBadRequest, TelegramRetryAfter
+import tiktoken
 from chatgpt_md_converter import telegram_format
 
 
@@ -34,10 +39,9 @@ import gemini_utils
 
 
 import file_utils
-import pptx_utils
 
 
-import json
+import orjson
 import re
 
 
@@ -48,66 +52,231 @@ logging.basicConfig(format='%(levelname)s - %(message)s',level=logging.INFO)
 logger = logging.getLogger(__name__)
 
 db = database.Database()
-bot = Bot(token=config.telegram_token, default=DefaultBotProperties(parse_mode=ParseMode.HTML))
-storage = MemoryStorage()
-dp = Dispatcher(storage=storage)
+
+# Kengaytirilgan connection pool — parallel send_photo/send_message'lar
+# default kichik pool navbatida qotib qolmasligi uchun
+_bot_session = AiohttpSession()
+_bot_session._connector_init.update(
+    limit=100,
+    limit_per_host=32,
+    ttl_dns_cache=300,
+    enable_cleanup_closed=True,
+)
+bot = Bot(
+    token=config.telegram_token,
+    session=_bot_session,
+    default=DefaultBotProperties(parse_mode=ParseMode.HTML),
+)
+dp = Dispatcher()
 router = Router()
-user_locks = {}
+
+
+class LockPool:
+    """Per-user asyncio.Lock'lar uchun chegaralangan LRU pool (bo'sh turgan userlar evict qilinadi)"""
+
+    def __init__(self, max_size: int = 10_000):
+        self.max_size = max_size
+        self._locks: OrderedDict[int, list] = OrderedDict()  # user_id -> [Lock, last_used_ts]
+
+    def get(self, user_id: int) -> asyncio.Lock:
+        entry = self._locks.get(user_id)
+        if entry is None:
+            entry = [asyncio.Lock(), time.monotonic()]
+            self._locks[user_id] = entry
+        else:
+            entry[1] = time.monotonic()
+            self._locks.move_to_end(user_id)
+
+        while len(self._locks) > self.max_size:
+            old_id, old_entry = self._locks.popitem(last=False)
+            if old_entry[0].locked():
+                # faol lock'ni tashlab bo'lmaydi — boshiga qaytarib qo'yamiz
+                self._locks[old_id] = old_entry
+                self._locks.move_to_end(old_id, last=False)
+                break
+
+        return entry[0]
+
+    def locked(self, user_id: int) -> bool:
+        entry = self._locks.get(user_id)
+        return entry is not None and entry[0].locked()
+
+    def sweep(self, max_idle: float):
+        now = time.monotonic()
+        for uid in [uid for uid, (lock, ts) in self._locks.items()
+                    if not lock.locked() and now - ts > max_idle]:
+            self._locks.pop(uid, None)
+
+    def stats(self) -> dict:
+        return {
+            "size": len(self._locks),
+            "locked": sum(1 for lock, _ in self._locks.values() if lock.locked()),
+        }
+
+    async def sweeper(self, interval: float = 300, max_idle: float = None):
+        if max_idle is None:
+            max_idle = config.new_dialog_timeout * 2
+        while True:
+            await asyncio.sleep(interval)
+            self.sweep(max_idle)
+            logger.debug(f"LockPool stats: {self.stats()}")
+
+
+user_locks = LockPool()
 user_tasks = {}
 BOT_USER = None
+# main()'da get_me'dan keyin to'ldiriladi — har xabarda qayta yasalmaydi
+BOT_ID = None
+BOT_MENTION = ""
+
+# Streaming paytida placeholder'ni tahrirlash oralig'i (Telegram limitiga urilmaslik uchun)
+STREAM_EDIT_INTERVAL = 0.7
+# Oraliq edit uchun kamida shuncha yangi belgi yig'ilishi kerak
+STREAM_EDIT_MIN_CHARS = 300
+
+# Har xabarda ishlatiladigan regex'lar bir marta kompilyatsiya qilinadi
+IMAGE_RE = re.compile(r"(rasm|surat|tasvir).*(chiz|yarat|yasab|tayyorla)|(draw|generate|create).*(image|picture|photo)")
+PRESO_RE = re.compile(r"(presentatsiya|slayd|prezentatsiya).*(tayyorla|yarat|qil)")
+# GPT javobidan JSON massivni fence'larni split qilmasdan ajratib olish uchun
+_JSON_ARRAY_RE = re.compile(r"\[.*\]", re.DOTALL)
+SPLIT_RE = re.compile(r'\|\s*-{3,}\s*\||\n\s*-{3,}\s*\n')
+
+# ChatGPT instansiyalari holatsiz — model bo'yicha bittadan yetadi
+_chatgpt_clients: dict[str, "openai_utils.ChatGPT"] = {}
+
+
+def get_chatgpt(model: str) -> "openai_utils.ChatGPT":
+    return _chatgpt_clients.setdefault(model, openai_utils.ChatGPT(model=model))
+
+
+# Hujjat matni promptga belgi emas, token bo'yicha kesiladi
+_DOC_ENCODING = tiktoken.get_encoding("cl100k_base")
+MAX_DOC_TOKENS = 4000
+_WHITESPACE_RE = re.compile(r"[ \t]{2,}")
+
+
+def _truncate_doc_text(text: str) -> str:
+    """Ortiqcha bo'sh joylarni yig'ib, matnni MAX_DOC_TOKENS tokenga qisqartirish"""
+    text = _WHITESPACE_RE.sub(" ", text)
+    tokens = _DOC_ENCODING.encode(text)
+    if len(tokens) > MAX_DOC_TOKENS:
+        text = _DOC_ENCODING.decode(tokens[:MAX_DOC_TOKENS])
+    return text
+
+
+# Qayta yuborilgan fayllar uchun extract natijasi cache'i (kalit: ext + sha256)
+_EXTRACT_CACHE_MAX = 128
+_extract_cache: OrderedDict[str, str] = OrderedDict()
+
+
+# Whisper natijalari cache'i — file_unique_id Telegram'ning kontent-manzilli kaliti,
+# bir xil audio qayta yuborilsa API chaqirig'i (pul va soniyalar) tejaladi
+_TRANSCRIPTION_CACHE_MAX = 256
+_transcription_cache: OrderedDict[str, str] = OrderedDict()
+
+
+# Telegram ingress'ni OpenAI/Mongo ishidan ajratish uchun worker pool
+MESSAGE_QUEUE_SIZE = 256
+N_MESSAGE_WORKERS = 8
+message_queue: asyncio.Queue = asyncio.Queue(maxsize=MESSAGE_QUEUE_SIZE)
+
+
+async def enqueue_message(message: Message, text: str = None):
+    """Xabarni worker navbatiga qo'yish; navbat to'la bo'lsa userga xabar beramiz"""
+    try:
+        message_queue.put_nowait((message, text))
+    except asyncio.QueueFull:
+        await send_reply(message, "⚠️ Yuklama yuqori, birozdan keyin qayta urinib ko'ring")
+
+
+async def message_worker():
+    while True:
+        message, text = await message_queue.get()
+        try:
+            await process_message(message, text=text)
+        except Exception:
+            logger.exception("Error in message worker")
+        finally:
+            message_queue.task_done()
 
 def split_text_smart(text: str, limit: int = 2500) -> list[str]:
     """Matnni paragraflar va yangi qatorlar bo'yicha aqlli bo'laklash"""
+    # Ko'p javoblar bitta chunkka sig'adi — split/join aylanasiz qaytaramiz
+    # (+2 — paragraf yig'ishdagi yakuniy \n\n hisobga olinadi)
+    if len(text) + 2 <= limit:
+        return [text.strip()]
+
     chunks = []
-    current_chunk = ""
-    
+    # str += o'rniga fragmentlar ro'yxati + join — har iteratsiyada butun
+    # chunkni qayta ko'chirmaslik uchun uzunlikni alohida hisoblab boramiz
+    cur_parts: list[str] = []
+    cur_len = 0
+
     # 1. Paragraflar bo'yicha bo'lish (eng mantiqiy bo'linish)
     paragraphs = text.split('\n\n')
-    
+
     for para in paragraphs:
         # Agar joriy chunk + yangi paragraf limitdan oshmasa
-        if len(current_chunk) + len(para) + 2 <= limit:
-            current_chunk += para + "\n\n"
+        if cur_len + len(para) + 2 <= limit:
+            cur_parts.append(para + "\n\n")
+            cur_len += len(para) + 2
         else:
             # Agar joriy chunk bo'sh bo'lmasa, uni saqlaymiz
-            if current_chunk:
-                chunks.append(current_chunk.strip())
-                current_chunk = ""
-            
+            if cur_parts:
+                chunks.append("".join(cur_parts).strip())
+                cur_parts = []
+                cur_len = 0
+
             # Agar paragrafning o'zi limitdan katta bo'lsa (masalan uzun kod)
             if len(para) > limit:
                 # Uni qatorlar bo'yicha bo'lamiz
                 lines = para.split('\n')
                 for line in lines:
-                    if len(current_chunk) + len(line) + 1 <= limit:
-                        current_chunk += line + "\n"
+                    if cur_len + len(line) + 1 <= limit:
+                        cur_parts.append(line + "\n")
+                        cur_len += len(line) + 1
                     else:
-                        chunks.append(current_chunk.strip())
-                        current_chunk = line + "\n"
+                        chunks.append("".join(cur_parts).strip())
+                        cur_parts = [line + "\n"]
+                        cur_len = len(line) + 1
             else:
-                current_chunk = para + "\n\n"
-                
-    if current_chunk:
-        chunks.append(current_chunk.strip())
-        
+                cur_parts = [para + "\n\n"]
+                cur_len = len(para) + 2
+
+    if cur_parts:
+        chunks.append("".join(cur_parts).strip())
+
     return chunks
 
 # ==========================================
 # HELPER FUNCTIONS
 # ==========================================
+# Yopiluvchi blok teglar \n ga, qolganlari bo'sh satrga almashtiriladi
+_CLEAN_RE = re.compile(r'</?(?:html|body|head|p|div)>|<br\s*/?>')
+_CLEAN_REPL = {"</p>": "\n", "<br>": "\n", "<br/>": "\n", "<br />": "\n", "</div>": "\n"}
+
 def clean_html_for_telegram(text: str) -> str:
     """Telegram qo'llamaydigan HTML teglarni tozalash (chatgpt_md_converter ba'zan body/html qo'shib yuboradi)"""
-    # Remove containers
-    invalid_tags = ["<html>", "</html>", "<body>", "</body>", "<head>", "</head>"]
-    for tag in invalid_tags:
-        text = text.replace(tag, "")
-    
-    # Replace block tags
-    text = text.replace("<p>", "").replace("</p>", "\n")
-    text = text.replace("<br>", "\n").replace("<br/>", "\n").replace("<br />", "\n")
-    text = text.replace("<div>", "").replace("</div>", "\n")
-    
-    return text
+    # 13 ta ketma-ket .replace() o'rniga matn ustidan bitta o'tish
+    return _CLEAN_RE.sub(lambda m: _CLEAN_REPL.get(m.group(0), ""), text)
+
+@asynccontextmanager
+async def chat_action(chat_id: int, action: str = ChatAction.TYPING):
+    """Indikatorni ish tugaguncha ushlab turish (Telegram ~5s'da o'chiradi, har 4s'da qayta yuboramiz)"""
+    async def _loop():
+        while True:
+            try:
+                await bot.send_chat_action(chat_id=chat_id, action=action)
+            except Exception:
+                pass
+            await asyncio.sleep(4)
+
+    task = asyncio.create_task(_loop())
+    try:
+        yield
+    finally:
+        task.cancel()
+
 
 async def send_reply(message: Message, text: str, parse_mode=None):
     """Guruhda reply, shaxsiyda oddiy xabar"""
@@ -121,54 +290,86 @@ async def register_user_if_not_exists(message: Message):
         user = message.from_user
         chat_id = message.chat.id
 
-        if not db.check_if_user_exists(user.id):
+        if not await db.check_if_user_exists(user.id):
             logger.info(f"Registering new user: {user.username} ({user.id})")
-            db.add_new_user(
+            await db.add_new_user(
                 user.id,
                 chat_id,
                 username=user.username or "",
                 first_name=user.first_name or "",
                 last_name=user.last_name or ""
             )
-            db.start_new_dialog(user.id)
+            await db.start_new_dialog(user.id)
+
+        attrs = await db.get_user_attributes_bulk(user.id, [
+            "current_dialog_id",
+            "current_model",
+            "n_used_tokens",
+            "n_transcribed_seconds",
+            "n_generated_images",
+            "schema_version",
+        ])
 
-        if db.get_user_attribute(user.id, "current_dialog_id") is None:
-            db.start_new_dialog(user.id)
+        if attrs["current_dialog_id"] is None:
+            await db.start_new_dialog(user.id)
 
-        if user.id not in user_locks:
-            user_locks[user.id] = asyncio.Lock()
+        user_locks.get(user.id)
 
-        if db.get_user_attribute(user.id, "current_model") is None:
-            db.set_user_attribute(user.id, "current_model", config.models["available_text_models"][0])
+        # Sxema joriy versiyada bo'lsa, quyidagi migratsiya tekshiruvlari no-op — o'tkazib yuboramiz
+        if attrs["schema_version"] == database.SCHEMA_VERSION:
+            return
+
+        # Legacy hujjat: yetishmagan maydonlar bitta $set bilan to'ldiriladi
+        patch = {}
+
+        if attrs["current_model"] is None:
+            patch["current_model"] = config.models["available_text_models"][0]
 
         # Backward compatibility
-        n_used_tokens = db.get_user_attribute(user.id, "n_used_tokens")
+        n_used_tokens = attrs["n_used_tokens"]
         if n_used_tokens is None:
-            n_used_tokens = {}
-            db.set_user_attribute(user.id, "n_used_tokens", n_used_tokens)
+            patch["n_used_tokens"] = {}
         elif isinstance(n_used_tokens, (int, float)):
-            new_n_used_tokens = {
+            patch["n_used_tokens"] = {
                 "gpt-3.5-turbo": {
                     "n_input_tokens": 0,
                     "n_output_tokens": n_used_tokens
                 }
             }
-            db.set_user_attribute(user.id, "n_used_tokens", new_n_used_tokens)
 
-        if db.get_user_attribute(user.id, "n_transcribed_seconds") is None:
-            db.set_user_attribute(user.id, "n_transcribed_seconds", 0.0)
+        if attrs["n_transcribed_seconds"] is None:
+            patch["n_transcribed_seconds"] = 0.0
+
+        if attrs["n_generated_images"] is None:
+            patch["n_generated_images"] = 0
 
-        if db.get_user_attribute(user.id, "n_generated_images") is None:
-            db.set_user_attribute(user.id, "n_generated_images", 0)
+        patch["schema_version"] = database.SCHEMA_VERSION
+        db.set_user_attributes(user.id, patch)
 
     except Exception as e:
         logger.error(f"Error in register_user_if_not_exists: {e}")
 
 
-def is_user_allowed(user_id: int) -> bool:
-    if not config.allowed_telegram_usernames:
+def is_user_allowed(user) -> bool:
+    if not config.access_restricted:
         return True
-    return user_id in config.allowed_telegram_usernames
+    if user.id in config.allowed_user_ids:
+        return True
+    username = user.username
+    return username is not None and username.lower() in config.allowed_usernames
+
+
+class AccessMiddleware(BaseMiddleware):
+    """Ruxsatsiz userlarni handlerlargacha yetkazmasdan to'xtatish (har handlerda takror tekshiruv o'rniga)"""
+
+    async def __call__(self, handler, event, data):
+        user = getattr(event, "from_user", None)
+        if user is not None and not is_user_allowed(user):
+            if isinstance(event, Message) and event.chat.type == "private":
+                await event.answer("❌ Sizda botdan foydalanish huquqi yo'q.")
+            return
+
+        return await handler(event, data)
 
 
 # ==========================================
@@ -176,15 +377,11 @@ def is_user_allowed(user_id: int) -> bool:
 # ==========================================
 @router.message(CommandStart())
 async def start_handler(message: Message):
-    if not is_user_allowed(message.from_user.id):
-        await message.answer("❌ Sizda botdan foydalanish huquqi yo'q.")
-        return
-
     await register_user_if_not_exists(message)
     user_id = message.from_user.id
 
-    db.set_user_attribute(user_id, "last_interaction", datetime.now())
-    db.start_new_dialog(user_id)
+    db.touch(user_id)
+    await db.start_new_dialog(user_id)
 
     await message.answer(
         f"👋 <b>Assalomu alaykum, {message.from_user.full_name}!</b>\n"
@@ -202,9 +399,6 @@ async def start_handler(message: Message):
 
 @router.message(Command("help"))
 async def help_handler(message: Message):
-    if not is_user_allowed(message.from_user.id):
-        return
-
     await register_user_if_not_exists(message)
     await message.answer(
         """<b>📚 Buyruqlar:</b>
@@ -223,33 +417,25 @@ async def help_handler(message: Message):
 
 @router.message(Command("new"))
 async def new_dialog_handler(message: Message):
-    if not is_user_allowed(message.from_user.id):
-        return
-
     await register_user_if_not_exists(message)
     user_id = message.from_user.id
 
-    if user_id not in user_locks:
-        user_locks[user_id] = asyncio.Lock()
-    if user_locks[user_id].locked():
+    if user_locks.locked(user_id):
         await message.answer("⏳ Iltimos, oldingi xabarga javobni kuting\nYoki /cancel bilan bekor qiling")
         return
 
-    db.set_user_attribute(user_id, "last_interaction", datetime.now())
-    db.start_new_dialog(user_id)
+    db.touch(user_id)
+    await db.start_new_dialog(user_id)
     
     await message.answer("✅ Yangi suhbat boshlandi")
 
-    chat_mode = db.get_user_attribute(user_id, "current_chat_mode")
-    welcome_text = config.chat_modes[chat_mode]['welcome_message']
+    chat_mode = await db.get_user_attribute(user_id, "current_chat_mode")
+    welcome_text = config.chat_modes[chat_mode].welcome_message
     await message.answer(welcome_text)
 
 
 @router.message(Command("cancel"))
 async def cancel_handler(message: Message):
-    if not is_user_allowed(message.from_user.id):
-        return
-
     await register_user_if_not_exists(message)
     user_id = message.from_user.id
 
@@ -266,27 +452,22 @@ async def cancel_handler(message: Message):
 
 @router.message(Command("retry"))
 async def retry_handler(message: Message):
-    if not is_user_allowed(message.from_user.id):
-        return
-
     await register_user_if_not_exists(message)
     user_id = message.from_user.id
 
-    if user_id not in user_locks:
-        user_locks[user_id] = asyncio.Lock()
-    if user_locks[user_id].locked():
+    if user_locks.locked(user_id):
         await message.answer("⏳ Iltimos, oldingi xabarga javobni kuting")
         return
 
-    db.set_user_attribute(user_id, "last_interaction", datetime.now())
+    db.touch(user_id)
 
-    dialog_messages = db.get_dialog_messages(user_id)
+    dialog_messages = await db.get_dialog_messages(user_id)
     if len(dialog_messages) == 0:
         await message.answer("❌ Qayta yaratish uchun xabar yo'q")
         return
 
     last_dialog_message = dialog_messages.pop()
-    db.set_dialog_messages(user_id, dialog_messages)
+    await db.set_dialog_messages(user_id, dialog_messages)
 
     user_message = last_dialog_message["user"]
     if isinstance(user_message, list):
@@ -301,22 +482,26 @@ async def retry_handler(message: Message):
 # ==========================================
 # CHAT MODE HANDLERS
 # ==========================================
+# Rejimlar static — kalitlar ro'yxati va soni bir marta hisoblanadi
+_CHAT_MODE_KEYS = list(config.chat_modes.keys())
+_N_CHAT_MODES = len(_CHAT_MODE_KEYS)
+
+
 def get_chat_mode_menu(page_index: int = 0):
     n_per_page = config.n_chat_modes_per_page
-    text = f"<b>🎭 Suhbat rejimini tanlang</b> ({len(config.chat_modes)} ta rejim mavjud):"
+    text = f"<b>🎭 Suhbat rejimini tanlang</b> ({_N_CHAT_MODES} ta rejim mavjud):"
 
-    chat_mode_keys = list(config.chat_modes.keys())
-    page_keys = chat_mode_keys[page_index * n_per_page:(page_index + 1) * n_per_page]
+    page_keys = _CHAT_MODE_KEYS[page_index * n_per_page:(page_index + 1) * n_per_page]
 
     keyboard = []
     for key in page_keys:
-        name = config.chat_modes[key]["name"]
+        name = config.chat_modes[key].name
         keyboard.append([InlineKeyboardButton(text=name, callback_data=f"mode:{key}")])
 
     # Pagination
-    if len(chat_mode_keys) > n_per_page:
+    if _N_CHAT_MODES > n_per_page:
         is_first = (page_index == 0)
-        is_last = ((page_index + 1) * n_per_page >= len(chat_mode_keys))
+        is_last = ((page_index + 1) * n_per_page >= _N_CHAT_MODES)
 
         nav_buttons = []
         if not is_first:
@@ -330,16 +515,20 @@ def get_chat_mode_menu(page_index: int = 0):
     return text, InlineKeyboardMarkup(inline_keyboard=keyboard)
 
 
+# Rejimlar menyusi static config'dan chiqadi — sahifalarni bir marta yasab olamiz
+_N_CHAT_MODE_PAGES = max(
+    1, -(-_N_CHAT_MODES // config.n_chat_modes_per_page)
+)
+CHAT_MODE_PAGES = [get_chat_mode_menu(i) for i in range(_N_CHAT_MODE_PAGES)]
+
+
 async def show_chat_modes(message: Message):
-    text, markup = get_chat_mode_menu(0)
+    text, markup = CHAT_MODE_PAGES[0]
     await message.answer(text, reply_markup=markup)
 
 
 @router.message(Command("mode"))
 async def mode_handler(message: Message):
-    if not is_user_allowed(message.from_user.id):
-        return
-
     await register_user_if_not_exists(message)
     await show_chat_modes(message)
 
@@ -350,7 +539,7 @@ async def modes_pagination_callback(callback: CallbackQuery):
     
     try:
         page_index = int(callback.data.split(":")[1])
-        text, markup = get_chat_mode_menu(page_index)
+        text, markup = CHAT_MODE_PAGES[page_index]
         await callback.message.edit_text(text, reply_markup=markup)
     except Exception as e:
         logger.error(f"Error in pagination: {e}")
@@ -373,11 +562,13 @@ async def set_chat_mode_callback(callback: CallbackQuery):
             await callback.answer("❌ Noma'lum rejim!", show_alert=True)
             return
 
+        # cache'ni isitamiz, shunda set darhol cache orqali ko'rinadi
+        await db.check_if_user_exists(user_id, raise_exception=True)
         db.set_user_attribute(user_id, "current_chat_mode", chat_mode)
-        db.start_new_dialog(user_id)
+        await db.start_new_dialog(user_id)
 
-        # welcome_text = f"✅ <b>{config.chat_modes[chat_mode]['name']}</b> rejimi tanlandi!\n\n"
-        welcome_text = config.chat_modes[chat_mode]['welcome_message']
+        # welcome_text = f"✅ <b>{config.chat_modes[chat_mode].name}</b> rejimi tanlandi!\n\n"
+        welcome_text = config.chat_modes[chat_mode].welcome_message
 
         await callback.message.answer(welcome_text)
         
@@ -388,36 +579,47 @@ async def set_chat_mode_callback(callback: CallbackQuery):
 # ==========================================
 # SETTINGS HANDLERS
 # ==========================================
-def get_settings_menu(user_id: int):
-    current_model = db.get_user_attribute(user_id, "current_model")
-    text = f"<b>⚙️ Sozlamalar</b>\n\n"
-    text += f"<b>Joriy model:</b> {config.models['info'][current_model]['name']}\n\n"
-    text += f"<i>{config.models['info'][current_model]['description']}</i>\n\n"
-    score_dict = config.models["info"][current_model]["scores"]
-    for score_key, score_value in score_dict.items():
-        text += "🟢" * score_value + "⚪️" * (5 - score_value) + f" – {score_key}\n"
-
-    text += "\n<b>Modelni tanlang:</b>"
+# 0..5 ball uchun tayyor shkala satrlari
+SCORE_BARS = tuple("🟢" * i + "⚪️" * (5 - i) for i in range(6))
+
+
+@functools.lru_cache(maxsize=None)
+def _settings_menu_for_model(current_model: str):
+    """Menyu matni faqat modelga bog'liq — har model uchun bir marta render qilamiz"""
+    info = config.models["info"][current_model]
+    parts = [
+        "<b>⚙️ Sozlamalar</b>\n\n",
+        f"<b>Joriy model:</b> {info.name}\n\n",
+        f"<i>{info.description}</i>\n\n",
+    ]
+    parts.extend(
+        f"{SCORE_BARS[score_value]} – {score_key}\n"
+        for score_key, score_value in info.scores.items()
+    )
+    parts.append("\n<b>Modelni tanlang:</b>")
+    text = "".join(parts)
 
     buttons = []
     for model_key in config.models["available_text_models"]:
-        title = config.models["info"][model_key]["name"]
+        title = config.models["info"][model_key].name
         if model_key == current_model:
             title = "✅ " + title
         buttons.append([InlineKeyboardButton(text=title, callback_data=f"model:{model_key}")])
-    
+
     return text, InlineKeyboardMarkup(inline_keyboard=buttons)
 
 
+async def get_settings_menu(user_id: int):
+    current_model = await db.get_user_attribute(user_id, "current_model")
+    return _settings_menu_for_model(current_model)
+
+
 @router.message(Command("settings"))
 async def settings_handler(message: Message):
-    if not is_user_allowed(message.from_user.id):
-        return
-
     await register_user_if_not_exists(message)
     user_id = message.from_user.id
     
-    text, markup = get_settings_menu(user_id)
+    text, markup = await get_settings_menu(user_id)
     await message.answer(text, reply_markup=markup)
 
 
@@ -432,10 +634,12 @@ async def set_model_callback(callback: CallbackQuery):
             await callback.answer("❌ Noma'lum model!", show_alert=True)
             return
 
+        # cache'ni isitamiz, shunda set darhol cache orqali ko'rinadi
+        await db.check_if_user_exists(user_id, raise_exception=True)
         db.set_user_attribute(user_id, "current_model", model_key)
-        db.start_new_dialog(user_id)
+        await db.start_new_dialog(user_id)
 
-        text, markup = get_settings_menu(user_id)
+        text, markup = await get_settings_menu(user_id)
         await callback.message.edit_text(text, reply_markup=markup)
         
     except Exception as e:
@@ -447,49 +651,51 @@ async def set_model_callback(callback: CallbackQuery):
 # ==========================================
 @router.message(Command("balance"))
 async def balance_handler(message: Message):
-    if not is_user_allowed(message.from_user.id):
-        return
-
     await register_user_if_not_exists(message)
     user_id = message.from_user.id
 
     total_spent = 0.0
     total_tokens = 0
 
-    n_used_tokens_dict = db.get_user_attribute(user_id, "n_used_tokens")
-    n_generated_images = db.get_user_attribute(user_id, "n_generated_images")
-    n_transcribed_seconds = db.get_user_attribute(user_id, "n_transcribed_seconds")
+    attrs = await db.get_user_attributes_bulk(user_id, [
+        "n_used_tokens", "n_generated_images", "n_transcribed_seconds"
+    ])
+    n_used_tokens_dict = attrs["n_used_tokens"]
+    n_generated_images = attrs["n_generated_images"]
+    n_transcribed_seconds = attrs["n_transcribed_seconds"]
+
+    details = ["<b>📊 Batafsil:</b>\n"]
 
-    text = "<b>💰 Balans</b>\n\n"
-    details = "<b>📊 Batafsil:</b>\n"
-    
     # Tokens
     for model_key in sorted(n_used_tokens_dict.keys()):
         n_in = n_used_tokens_dict[model_key]["n_input_tokens"]
         n_out = n_used_tokens_dict[model_key]["n_output_tokens"]
         total_tokens += n_in + n_out
 
-        price_in = config.models["info"][model_key]["price_per_1000_input_tokens"] * (n_in / 1000)
-        price_out = config.models["info"][model_key]["price_per_1000_output_tokens"] * (n_out / 1000)
+        price_in = config.models["info"][model_key].price_per_1000_input_tokens * (n_in / 1000)
+        price_out = config.models["info"][model_key].price_per_1000_output_tokens * (n_out / 1000)
         total_spent += price_in + price_out
 
-        details += f"• {model_key}: <b>${price_in + price_out:.3f}</b> / {n_in + n_out} token\n"
+        details.append(f"• {model_key}: <b>${price_in + price_out:.3f}</b> / {n_in + n_out} token\n")
 
     # Images
     if n_generated_images > 0:
-        image_cost = config.models["info"]["dalle-2"]["price_per_1_image"] * n_generated_images
+        image_cost = config.models["info"]["dalle-2"].price_per_1_image * n_generated_images
         total_spent += image_cost
-        details += f"• DALL·E 2: <b>${image_cost:.3f}</b> / {n_generated_images} rasm\n"
+        details.append(f"• DALL·E 2: <b>${image_cost:.3f}</b> / {n_generated_images} rasm\n")
 
     # Voice
     if n_transcribed_seconds > 0:
-        voice_cost = config.models["info"]["whisper"]["price_per_1_min"] * (n_transcribed_seconds / 60)
+        voice_cost = config.models["info"]["whisper"].price_per_1_min * (n_transcribed_seconds / 60)
         total_spent += voice_cost
-        details += f"• Whisper: <b>${voice_cost:.3f}</b> / {n_transcribed_seconds:.0f} soniya\n"
+        details.append(f"• Whisper: <b>${voice_cost:.3f}</b> / {n_transcribed_seconds:.0f} soniya\n")
 
-    text += f"<b>Jami xarajat:</b> ${total_spent:.3f}\n"
-    text += f"<b>Jami tokenlar:</b> {total_tokens}\n\n"
-    text += details
+    text = "".join([
+        "<b>💰 Balans</b>\n\n",
+        f"<b>Jami xarajat:</b> ${total_spent:.3f}\n",
+        f"<b>Jami tokenlar:</b> {total_tokens}\n\n",
+        *details,
+    ])
 
     await message.answer(text)
 
@@ -501,18 +707,16 @@ async def process_message(message: Message, text: str = None, use_new_dialog_tim
     await register_user_if_not_exists(message)
     user_id = message.from_user.id
 
-    if user_id not in user_locks:
-        user_locks[user_id] = asyncio.Lock()
-    if user_locks[user_id].locked():
+    if user_locks.locked(user_id):
         await message.answer("⏳ Iltimos, oldingi xabarga javobni kuting")
         return
 
-    chat_mode = db.get_user_attribute(user_id, "current_chat_mode")
+    chat_mode = await db.get_user_attribute(user_id, "current_chat_mode")
     
     # Rasm so'rovi tekshiruvi (Artistdan boshqa rejimda)
     if chat_mode != "artist":
         _text_check = (text or message.text or message.caption or "").lower()
-        if re.search(r"(rasm|surat|tasvir).*(chiz|yarat|yasab|tayyorla)|(draw|generate|create).*(image|picture|photo)", _text_check):
+        if IMAGE_RE.search(_text_check):
             await send_reply(message, "🎨 Rasm yaratish uchun <b>Rassom</b> rejimiga o'ting!\n/mode buyrug'ini bosing va Rassom ni tanlang.", parse_mode=ParseMode.HTML)
             return
 
@@ -534,91 +738,112 @@ async def process_message(message: Message, text: str = None, use_new_dialog_tim
     # Regex: "presentatsiya" yoki "slayd" va "tayyorla" yoki "yarat" so'zlari qatnashsa
     _msg_text = (text or message.text or "").lower()
 
-    if chat_mode == "assistant" and re.search(r"(presentatsiya|slayd|prezentatsiya).*(tayyorla|yarat|qil)", _msg_text):
+    if chat_mode == "assistant" and PRESO_RE.search(_msg_text):
         await message.reply("📊 Presentatsiya strukturasini tuzib, fayl yaratayapman... ⏳")
         await generate_presentation_handler(message, text or message.text)
         return
 
 
-    current_model = db.get_user_attribute(user_id, "current_model")
+    current_model = await db.get_user_attribute(user_id, "current_model")
 
 
     async def message_task():
         if use_new_dialog_timeout:
-            last_interaction = db.get_user_attribute(user_id, "last_interaction")
-            if (datetime.now() - last_interaction).seconds > config.new_dialog_timeout:
-                if len(db.get_dialog_messages(user_id)) > 0:
-                    db.start_new_dialog(user_id)
-                    mode_name = config.chat_modes[chat_mode]['name']
+            last_interaction = await db.get_user_attribute(user_id, "last_interaction")
+            # .seconds kun qismini tashlab yuboradi — to'liq farq total_seconds'da
+            if (datetime.now() - last_interaction).total_seconds() > config.new_dialog_timeout:
+                if len(await db.get_dialog_messages(user_id)) > 0:
+                    await db.start_new_dialog(user_id)
+                    mode_name = config.chat_modes[chat_mode].name
                     await message.answer(f"⏰ Vaqt tugadi. Yangi suhbat (<b>{mode_name}</b>) ✅")
         
-        db.set_user_attribute(user_id, "last_interaction", datetime.now())
+        db.touch(user_id)
 
         n_input_tokens, n_output_tokens = 0, 0
 
         try:
-            placeholder = await send_reply(message, "✏️", parse_mode=None)
-            await bot.send_chat_action(chat_id=message.chat.id, action=ChatAction.TYPING)
-
-
-
+            # bo'sh xabarni placeholder yuborilmasdan oldin qaytaramiz — bitta API chaqiriq tejaladi
             _text = text or message.text
             if not _text:
                 await message.answer("❌ Bo'sh xabar")
                 return
 
+            placeholder = await send_reply(message, "✏️", parse_mode=None)
+            # streaming'da placeholder baribir tez edit bo'ladi — typing indikatori ortiqcha RTT
+            if not config.enable_message_streaming:
+                asyncio.create_task(bot.send_chat_action(chat_id=message.chat.id, action=ChatAction.TYPING))
+
             # Agar guruhda bo'lsa va boshqa user xabariga reply qilingan bo'lsa, kontekstni qo'shish
             if message.chat.type in ["group", "supergroup"] and message.reply_to_message:
-                if BOT_USER and message.reply_to_message.from_user.id != BOT_USER.id:
+                if BOT_ID and message.reply_to_message.from_user.id != BOT_ID:
                     # Agar xabar reply bo'lsa (lekin botga emas), reply qilingan xabarni kontekstga qo'shamiz
                     reply_text = message.reply_to_message.text or message.reply_to_message.caption or "[Rasm/Fayl]"
                     _text = f"Foydalanuvchi quyidagi xabarga javob bermoqda:\n'''{reply_text}'''\n\nFoydalanuvchi savoli:\n{_text}"
 
-            dialog_messages = db.get_dialog_messages(user_id)
+            dialog_messages = await db.get_dialog_messages(user_id)
 
             
-            chatgpt = openai_utils.ChatGPT(model=current_model)
+            chatgpt = get_chatgpt(current_model)
             
+            loop = asyncio.get_running_loop()
+            full_answer = ""
+            last_edit_hash = 0
+            n_removed = 0
+
             if config.enable_message_streaming:
                 gen = chatgpt.send_message_stream(_text, dialog_messages=dialog_messages, chat_mode=chat_mode)
+                # issiq siklda atribut qidiruvlarini lokal nomlarga bog'laymiz
+                now = loop.time
+                edit_text = placeholder.edit_text
+                last_edit_at = now()
+                prev_len = 0
+                bytes_since_edit = 0
+                async for status, answer, (n_input_tokens, n_output_tokens), n_removed in gen:
+                    full_answer = answer
+
+                    if status == "finished":
+                        # yakuniy matn pastda bir marta formatlanib yuboriladi
+                        break
+
+                    # Debounce: monoton hisoblagich — oxirgi edit'dan beri yig'ilgan belgilar
+                    # (kesish faqat haqiqiy edit oldidan — har chunkda 4KB nusxa olinmaydi)
+                    alen = len(answer)
+                    display_len = alen if alen <= 4000 else 4003
+                    bytes_since_edit += max(display_len - prev_len, 0)
+                    prev_len = display_len
+                    if bytes_since_edit < STREAM_EDIT_MIN_CHARS or now() - last_edit_at < STREAM_EDIT_INTERVAL:
+                        continue
+
+                    display_answer = answer if alen <= 4000 else answer[:4000] + "..."
+
+                    # bir xil kontentni qayta edit qilib "message is not modified" olmaymiz
+                    display_hash = hash(display_answer)
+                    if display_hash == last_edit_hash:
+                        continue
+
+                    try:
+                        # Oraliq edit'lar xom matn bilan ketadi — markdown->HTML konvertatsiya
+                        # o'sib boruvchi prefiks ustida har safar qayta ishlamasligi uchun
+                        await edit_text(display_answer, parse_mode=None)
+                    except TelegramRetryAfter as e:
+                        await asyncio.sleep(e.retry_after)
+                    except Exception:
+                        pass
+
+                    last_edit_at = now()
+                    bytes_since_edit = 0
+                    last_edit_hash = display_hash
             else:
-                answer, (n_input_tokens, n_output_tokens), n_removed = await chatgpt.send_message(
+                # streaming o'chiq bo'lsa generator o'ramisiz to'g'ridan-to'g'ri bitta javob
+                full_answer, (n_input_tokens, n_output_tokens), n_removed = await chatgpt.send_message(
                     _text, dialog_messages=dialog_messages, chat_mode=chat_mode
                 )
-                async def fake_gen():
-                    yield "finished", answer, (n_input_tokens, n_output_tokens), n_removed
-                gen = fake_gen()
-
-            full_answer = ""
-            prev_answer = ""
-            async for status, answer, (n_input_tokens, n_output_tokens), n_removed in gen:
-                full_answer = answer
-                
-                # Streaming uchun qisqartirilgan versiya
-                if len(answer) > 4000:
-                    display_answer = answer[:4000] + "..."
-                else:
-                    display_answer = answer
-                
-                if abs(len(display_answer) - len(prev_answer)) < 100 and status != "finished":
-                    continue
-
-                try:
-                    formatted_display = clean_html_for_telegram(telegram_format(display_answer))
-                    await placeholder.edit_text(formatted_display, parse_mode= ParseMode.HTML)
-                except Exception:
-                    pass
-
-
-                await asyncio.sleep(0.7)
-                prev_answer = display_answer
 
             
             # Yakuniy javobni bo'laklab yuborish
             # |---| yoki yangi qatordagi ---
-            split_pattern = r'\|\s*-{3,}\s*\||\n\s*-{3,}\s*\n'
-            if re.search(split_pattern, full_answer):
-                chunks = [c.strip() for c in re.split(split_pattern, full_answer) if c.strip()]
+            if SPLIT_RE.search(full_answer):
+                chunks = [c.strip() for c in SPLIT_RE.split(full_answer) if c.strip()]
             else:
                 chunks = split_text_smart(full_answer)
 
@@ -626,21 +851,28 @@ async def process_message(message: Message, text: str = None, use_new_dialog_tim
 
             
             # Birinchi bo'lak (placeholder o'rniga)
+            formatted = clean_html_for_telegram(telegram_format(chunks[0]))
+            if hash(formatted) == last_edit_hash:
+                # oxirgi stream edit aynan shu matnni ko'rsatgan — qayta edit ortiqcha
+                formatted = None
             try:
-                formatted = clean_html_for_telegram(telegram_format(chunks[0]))
-                await placeholder.edit_text(formatted, parse_mode=ParseMode.HTML)
+                if formatted is not None:
+                    await placeholder.edit_text(formatted, parse_mode=ParseMode.HTML)
             except TelegramBadRequest as e:
-                if "message is not modified" in str(e):
+                # str(e) o'rniga tayyor .message — har safar format qilinmaydi
+                if "message is not modified" in e.message:
                     pass # Formatlash to'g'ri, shunchaki o'zgartirish shart emas
+                elif "can't parse entities" in e.message:
+                    await placeholder.edit_text(chunks[0], parse_mode=None) # Formatlashsiz qayta
                 else:
-                    await placeholder.edit_text(chunks[0], parse_mode=None) # Boshqa xato (masalan parse error)
+                    # boshqa BadRequest'da plain retry ham baribir yiqiladi — ortiqcha RTT qilmaymiz
+                    logger.warning(f"Final edit failed: {e.message}")
             except Exception:
                 await placeholder.edit_text(chunks[0], parse_mode=None) # Fallback
 
             
-            # Qolgan bo'laklar
+            # Qolgan bo'laklar — awaitning o'zi tartibni saqlaydi, qo'shimcha pauza shart emas
             for chunk in chunks[1:]:
-                await asyncio.sleep(0.1) # Tartibni saqlash uchun
                 try:
                     formatted = clean_html_for_telegram(telegram_format(chunk))
                     await send_reply(message, formatted, parse_mode=ParseMode.HTML)
@@ -656,7 +888,7 @@ async def process_message(message: Message, text: str = None, use_new_dialog_tim
                 "date": datetime.now()
             }
 
-            db.set_dialog_messages(user_id, db.get_dialog_messages(user_id) + [new_msg])
+            await db.append_dialog_message(user_id, new_msg)
             db.update_n_used_tokens(user_id, current_model, n_input_tokens, n_output_tokens)
 
             # Warning
@@ -667,12 +899,11 @@ async def process_message(message: Message, text: str = None, use_new_dialog_tim
         except asyncio.CancelledError:
             db.update_n_used_tokens(user_id, current_model, n_input_tokens, n_output_tokens)
             raise
-        except Exception as e:
-            logger.error(f"Error processing message: {e}")
-            logger.error(traceback.format_exc())
+        except Exception:
+            logger.exception("Error processing message")
             await message.answer("❌ Xatolik yuz berdi")
 
-    async with user_locks[user_id]:
+    async with user_locks.get(user_id):
         try:
             if message.photo:
                 if current_model not in ["gpt-4o"]:
@@ -683,39 +914,43 @@ async def process_message(message: Message, text: str = None, use_new_dialog_tim
                 task = asyncio.create_task(message_task())
 
             user_tasks[user_id] = task
-            
+            # registry task tugashi bilan tozalanadi — xato yo'llarida ham yetim yozuv qolmaydi
+            task.add_done_callback(lambda _t, uid=user_id: user_tasks.pop(uid, None))
+
             try:
-                await task
+                # osilib qolgan task lockni abadiy ushlab turmasligi uchun
+                async with asyncio.timeout(config.processing_timeout):
+                    await task
             except asyncio.CancelledError:
                 await message.answer("✅ Bekor qilindi")
-            finally:
-                if user_id in user_tasks:
-                    del user_tasks[user_id]
-                    
-        except Exception as e:
-            logger.error(f"Error in process_message: {e}")
-            logger.error(traceback.format_exc())
-            if user_id in user_tasks:
-                del user_tasks[user_id]
+            except TimeoutError:
+                # asyncio.timeout faqat tashqi kutishni uzadi — ichki task'ni ham
+                # bekor qilamiz, aks holda u lock bo'shagach ham streaming va
+                # dialog yozuvlarini davom ettiradi
+                task.cancel()
+                with suppress(asyncio.CancelledError):
+                    await task
+                await message.answer("❌ Vaqt tugadi, so'rov bekor qilindi. Qayta urinib ko'ring")
+
+        except Exception:
+            logger.exception("Error in process_message")
 
 @router.message((F.text & ~F.text.startswith('/')) | F.photo)
 async def text_message_handler(message: Message):
 
-    if not is_user_allowed(message.from_user.id):
-        return
-
     # Guruhda ishlayotganligini tekshirish
     if message.chat.type in ["group", "supergroup"]:
         # Agar botga reply qilinmagan bo'lsa va bot username message ichida bo'lmasa, e'tiborsiz qoldirish
-        if BOT_USER:
-            is_reply_to_bot = message.reply_to_message and message.reply_to_message.from_user.id == BOT_USER.id
-            is_mentioned = BOT_USER.username in message.text
+        if BOT_ID:
+            is_reply_to_bot = message.reply_to_message and message.reply_to_message.from_user.id == BOT_ID
+            # rasm kelganda matn caption'da bo'ladi
+            is_mentioned = BOT_MENTION in (message.text or message.caption or "")
 
             if not is_reply_to_bot and not is_mentioned:
                 return
 
 
-    await process_message(message)
+    await enqueue_message(message)
 
 
 
@@ -724,9 +959,9 @@ async def text_message_handler(message: Message):
 # ==========================================
 async def process_vision_message(message: Message, use_new_dialog_timeout: bool = True):
     user_id = message.from_user.id
-    current_model = db.get_user_attribute(user_id, "current_model")
+    current_model = await db.get_user_attribute(user_id, "current_model")
 
-    chat_mode = db.get_user_attribute(user_id, "current_chat_mode")
+    chat_mode = await db.get_user_attribute(user_id, "current_chat_mode")
 
 
 
@@ -738,23 +973,31 @@ async def process_vision_message(message: Message, use_new_dialog_timeout: bool
 
     # Timeout
     if use_new_dialog_timeout:
-        last = db.get_user_attribute(user_id, "last_interaction")
-        if (datetime.now() - last).seconds > config.new_dialog_timeout:
-            if len(db.get_dialog_messages(user_id)) > 0:
-                db.start_new_dialog(user_id)
+        last = await db.get_user_attribute(user_id, "last_interaction")
+        if (datetime.now() - last).total_seconds() > config.new_dialog_timeout:
+            if len(await db.get_dialog_messages(user_id)) > 0:
+                await db.start_new_dialog(user_id)
     
-    db.set_user_attribute(user_id, "last_interaction", datetime.now())
+    db.touch(user_id)
 
-    # Download image
     buf = None
+    image_url = None
+    photo_file_id = None
     if message.photo:
         photo = message.photo[-1]
-        file = await bot.get_file(photo.file_id)
-        buf = BytesIO()
-        await bot.download_file(file.file_path, buf)
-        buf.name = "image.jpg"
-        buf.seek(0)
-    
+        photo_file_id = photo.file_id
+        file = await bot.get_file(photo_file_id)
+        if chat_mode == "artist":
+            # artist rejimida baytlar lokal kerak (DALL-E prompt uchun)
+            buf = BytesIO()
+            await bot.download_file(file.file_path, buf)
+            buf.name = "image.jpg"
+            buf.seek(0)
+        else:
+            # vision uchun Telegram file URL to'g'ridan-to'g'ri API'ga beriladi —
+            # lokal yuklab olish ham, base64 ham kerak emas
+            image_url = f"https://api.telegram.org/file/bot{config.telegram_token}/{file.file_path}"
+
     if chat_mode == "artist":
         prompt = message.caption
         if not prompt:
@@ -780,71 +1023,95 @@ async def process_vision_message(message: Message, use_new_dialog_timeout: bool
 
 
 
-        await bot.send_chat_action(chat_id=message.chat.id, action=ChatAction.TYPING)
+        if not config.enable_message_streaming:
+            asyncio.create_task(bot.send_chat_action(chat_id=message.chat.id, action=ChatAction.TYPING))
 
-        dialog_messages = db.get_dialog_messages(user_id)
+        dialog_messages = await db.get_dialog_messages(user_id)
         
-        chatgpt = openai_utils.ChatGPT(model=current_model)
+        chatgpt = get_chatgpt(current_model)
         
+        loop = asyncio.get_running_loop()
+        full_answer = ""
+        last_edit_hash = 0
+        n_removed = 0
+
         if config.enable_message_streaming:
             gen = chatgpt.send_vision_message_stream(
-                text, dialog_messages=dialog_messages, image_buffer=buf, chat_mode=chat_mode
-            )
-        else:
-            answer, (n_in, n_out), n_removed = await chatgpt.send_vision_message(
-                text, dialog_messages=dialog_messages, image_buffer=buf, chat_mode=chat_mode
+                text, dialog_messages=dialog_messages, image_url=image_url, chat_mode=chat_mode
             )
-            async def fake_gen():
-                yield "finished", answer, (n_in, n_out), n_removed
-            gen = fake_gen()
+            # issiq siklda atribut qidiruvlarini lokal nomlarga bog'laymiz
+            now = loop.time
+            edit_text = placeholder.edit_text
+            last_edit_at = now()
+            prev_len = 0
+            bytes_since_edit = 0
+            async for status, answer, (n_in, n_out), n_removed in gen:
+                full_answer = answer
 
-        full_answer = ""
-        prev_answer = ""
-        async for status, answer, (n_in, n_out), n_removed in gen:
-            full_answer = answer
-            
-            if len(answer) > 4000:
-                display_answer = answer[:4000] + "..."
-            else:
-                display_answer = answer
+                if status == "finished":
+                    # yakuniy matn pastda bir marta formatlanib yuboriladi
+                    break
 
-            if abs(len(display_answer) - len(prev_answer)) < 100 and status != "finished":
-                continue
+                # Debounce: monoton hisoblagich — kesish faqat haqiqiy edit oldidan
+                alen = len(answer)
+                display_len = alen if alen <= 4000 else 4003
+                bytes_since_edit += max(display_len - prev_len, 0)
+                prev_len = display_len
+                if bytes_since_edit < STREAM_EDIT_MIN_CHARS or now() - last_edit_at < STREAM_EDIT_INTERVAL:
+                    continue
 
-            try:
-                formatted_display = clean_html_for_telegram(telegram_format(display_answer))
-                await placeholder.edit_text(formatted_display, parse_mode= ParseMode.HTML)
-            except Exception:
-                pass
+                display_answer = answer if alen <= 4000 else answer[:4000] + "..."
+
+                # bir xil kontentni qayta edit qilib "message is not modified" olmaymiz
+                display_hash = hash(display_answer)
+                if display_hash == last_edit_hash:
+                    continue
+
+                try:
+                    # Oraliq edit'lar xom matn bilan ketadi — formatlash faqat yakunda
+                    await edit_text(display_answer, parse_mode=None)
+                except TelegramRetryAfter as e:
+                    await asyncio.sleep(e.retry_after)
+                except Exception:
+                    pass
 
-            await asyncio.sleep(0.7)
-            prev_answer = display_answer
+                last_edit_at = now()
+                bytes_since_edit = 0
+                last_edit_hash = display_hash
+        else:
+            # streaming o'chiq bo'lsa generator o'ramisiz to'g'ridan-to'g'ri bitta javob
+            full_answer, (n_in, n_out), n_removed = await chatgpt.send_vision_message(
+                text, dialog_messages=dialog_messages, image_url=image_url, chat_mode=chat_mode
+            )
 
 
         # Yakuniy javobni bo'laklab yuborish
-        split_pattern = r'\|\s*-{3,}\s*\||\n\s*-{3,}\s*\n'
-        if re.search(split_pattern, full_answer):
-            chunks = [c.strip() for c in re.split(split_pattern, full_answer) if c.strip()]
+        if SPLIT_RE.search(full_answer):
+            chunks = [c.strip() for c in SPLIT_RE.split(full_answer) if c.strip()]
         else:
             chunks = split_text_smart(full_answer)
 
 
 
         
+        formatted = clean_html_for_telegram(telegram_format(chunks[0]))
+        if hash(formatted) == last_edit_hash:
+            formatted = None
         try:
-            formatted = clean_html_for_telegram(telegram_format(chunks[0]))
-            await placeholder.edit_text(formatted, parse_mode=ParseMode.HTML)
+            if formatted is not None:
+                await placeholder.edit_text(formatted, parse_mode=ParseMode.HTML)
         except TelegramBadRequest as e:
-            if "message is not modified" in str(e):
+            if "message is not modified" in e.message:
                 pass
-            else:
+            elif "can't parse entities" in e.message:
                 await placeholder.edit_text(chunks[0], parse_mode=None)
+            else:
+                logger.warning(f"Final edit failed: {e.message}")
         except Exception:
             await placeholder.edit_text(chunks[0], parse_mode=None)
 
 
         for chunk in chunks[1:]:
-            await asyncio.sleep(0.1)
             try:
                 formatted = clean_html_for_telegram(telegram_format(chunk))
                 await send_reply(message, formatted, parse_mode=ParseMode.HTML)
@@ -856,11 +1123,10 @@ async def process_vision_message(message: Message, use_new_dialog_timeout: bool
 
 
         # Save
-        if buf:
-            buf.seek(0)
-            base_img = base64.b64encode(buf.getvalue()).decode("utf-8")
+        if photo_file_id:
+            # rasm Telegram'da turibdi — dialogda faqat file_id reference saqlanadi
             new_msg = {
-                "user": [{"type": "text", "text": text}, {"type": "image", "image": base_img}],
+                "user": [{"type": "text", "text": text}, {"type": "image_ref", "file_id": photo_file_id}],
                 "bot": full_answer,
                 "date": datetime.now()
             }
@@ -872,7 +1138,8 @@ async def process_vision_message(message: Message, use_new_dialog_timeout: bool
             }
 
         
-        db.set_dialog_messages(user_id, db.get_dialog_messages(user_id) + [new_msg])
+        # $push — tarixni qayta o'qib to'liq ro'yxatni yozib o'tirmaymiz
+        await db.append_dialog_message(user_id, new_msg)
         db.update_n_used_tokens(user_id, current_model, n_in, n_out)
 
     except Exception as e:
@@ -880,39 +1147,17 @@ async def process_vision_message(message: Message, use_new_dialog_timeout: bool
         await message.answer("❌ Xatolik")
 
 
-@router.message(F.photo)
-async def photo_handler(message: Message):
-    if not is_user_allowed(message.from_user.id):
-        return
-    
-    # Guruhda ishlayotganligini tekshirish
-    if message.chat.type in ["group", "supergroup"]:
-        if BOT_USER:
-            is_reply_to_bot = message.reply_to_message and message.reply_to_message.from_user.id == BOT_USER.id
-            is_mentioned = message.caption and BOT_USER.username in message.caption
-
-            if not is_reply_to_bot and not is_mentioned:
-                return
-
-
-    await register_user_if_not_exists(message)
-    await process_message(message)
-
-
 # ==========================================
 # FILE HANDLER
 # ==========================================
 @router.message(F.document)
 async def document_handler(message: Message):
     """Fayllarni o'qish (PDF, DOCX, TXT)"""
-    if not is_user_allowed(message.from_user.id):
-        return
-
     # Guruhda ishlash
     if message.chat.type in ["group", "supergroup"]:
-        if BOT_USER:
-            is_reply_to_bot = message.reply_to_message and message.reply_to_message.from_user.id == BOT_USER.id
-            is_mentioned = message.caption and BOT_USER.username in message.caption
+        if BOT_ID:
+            is_reply_to_bot = message.reply_to_message and message.reply_to_message.from_user.id == BOT_ID
+            is_mentioned = message.caption and BOT_MENTION in message.caption
             if not is_reply_to_bot and not is_mentioned:
                 return
 
@@ -926,26 +1171,42 @@ async def document_handler(message: Message):
         return
 
     wait_msg = await message.reply(f"📂 <b>{file_name}</b> tahlil qilinmoqda...")
-    await bot.send_chat_action(chat_id=message.chat.id, action=ChatAction.TYPING)
-
 
     try:
-        # Download
-        file = await bot.get_file(file_id)
-        file_buffer = BytesIO()
-        await bot.download_file(file.file_path, file_buffer)
-        file_buffer.seek(0)
-
-        # Extract text
-        text_content = file_utils.extract_text(file_buffer, file_ext)
+        async with chat_action(message.chat.id):
+            # Download — kichik fayllar RAMda, kattalari diskka spill bo'ladi
+            file = await bot.get_file(file_id)
+            file_buffer = tempfile.SpooledTemporaryFile(max_size=2 * 1024 * 1024)
+            await bot.download_file(file.file_path, file_buffer)
+
+            file_buffer.seek(0)
+            hasher = hashlib.sha256()
+            for chunk in iter(lambda: file_buffer.read(1024 * 1024), b""):
+                hasher.update(chunk)
+            file_buffer.seek(0)
+
+            # Extract text — bir xil fayl qayta yuborilsa parse o'rniga cache'dan olamiz
+            cache_key = f"{file_ext}:{hasher.hexdigest()}"
+            text_content = _extract_cache.get(cache_key)
+            if text_content is not None:
+                _extract_cache.move_to_end(cache_key)
+            else:
+                # PDF/docx parsing sof CPU ish — event loop'ni bloklamasligi uchun threadda
+                text_content = await asyncio.to_thread(file_utils.extract_text, file_buffer, file_ext)
+                if text_content:
+                    # promptga token bo'yicha kesilgan boshi kiradi — cache'da ham shu saqlanadi
+                    text_content = _truncate_doc_text(text_content)
+                    _extract_cache[cache_key] = text_content
+                    if len(_extract_cache) > _EXTRACT_CACHE_MAX:
+                        _extract_cache.popitem(last=False)
 
         if text_content:
             # Promptga qo'shish
             user_input = message.caption or "Ushbu faylni tahlil qiling va qisqacha mazmunini ayting."
-            prompt = f"Men quyidagi faylni yukladim: {file_name}\n\nFayl mazmuni (boshi):\n'''{text_content[:15000]}'''\n...\n\nFoydalanuvchi so'rovi: {user_input}"
+            prompt = f"Men quyidagi faylni yukladim: {file_name}\n\nFayl mazmuni (boshi):\n'''{text_content}'''\n...\n\nFoydalanuvchi so'rovi: {user_input}"
             
             await wait_msg.delete()
-            await process_message(message, text=prompt)
+            await enqueue_message(message, text=prompt)
         else:
             await wait_msg.edit_text("❌ Faylni o'qib bo'lmadi.\nSabablar:\n1. Fayl bo'sh yoki shifrlangan.\n2. PDF rasmlardan iborat (matn qatlami yo'q).\n3. Noma'lum format.")
             
@@ -962,41 +1223,52 @@ async def document_handler(message: Message):
 @router.message(F.voice)
 async def voice_handler(message: Message):
     """Ovozli xabar"""
-    if not is_user_allowed(message.from_user.id):
-        return
+    # Guruh gating'i eng boshida — murojaat qilinmagan ovozlar uchun
+    # yuklab olish ham, pullik Whisper chaqirig'i ham bo'lmaydi
+    if message.chat.type in ["group", "supergroup"]:
+        if BOT_ID:
+            is_reply_to_bot = message.reply_to_message and message.reply_to_message.from_user.id == BOT_ID
 
-    await register_user_if_not_exists(message)
-    user_id = message.from_user.id
+            # Ovozli xabarda mention bo'lmaydi, faqat reply ga qarab ishlaymiz
+            if not is_reply_to_bot:
+                return
 
+    user_id = message.from_user.id
     voice = message.voice
-    file = await bot.get_file(voice.file_id)
-    
-    buf = BytesIO()
-    await bot.download_file(file.file_path, buf)
-    buf.name = "voice.oga"
-    buf.seek(0)
 
-    # Transcribe
-    transcribed = await openai_utils.transcribe_audio(buf)
-    await message.reply(f"🎤 <i>{transcribed}</i>")
+    transcribed = _transcription_cache.get(voice.file_unique_id)
+    if transcribed is not None:
+        # xuddi shu audio oldin ko'rilgan — yuklab olish ham, Whisper ham kerak emas
+        _transcription_cache.move_to_end(voice.file_unique_id)
+        await register_user_if_not_exists(message)
+    else:
+        # Registratsiya (Mongo) va get_file (Telegram) mustaqil — parallel bajaramiz,
+        # typing indikatori esa kutilmaydi
+        asyncio.create_task(bot.send_chat_action(chat_id=message.chat.id, action=ChatAction.TYPING))
+        _, file = await asyncio.gather(
+            register_user_if_not_exists(message),
+            bot.get_file(voice.file_id),
+        )
 
+        buf = BytesIO()
+        await bot.download_file(file.file_path, buf)
+        buf.name = "voice.oga"
+        buf.seek(0)
 
-    # Update stats
-    current = db.get_user_attribute(user_id, "n_transcribed_seconds")
-    duration = voice.duration or 0
-    db.set_user_attribute(user_id, "n_transcribed_seconds", duration + current)
+        # Transcribe
+        transcribed = await openai_utils.transcribe_audio(buf)
+        if transcribed:
+            _transcription_cache[voice.file_unique_id] = transcribed
+            if len(_transcription_cache) > _TRANSCRIPTION_CACHE_MAX:
+                _transcription_cache.popitem(last=False)
 
-    # Process
-    if message.chat.type in ["group", "supergroup"]:
-        if BOT_USER:
-            is_reply_to_bot = message.reply_to_message and message.reply_to_message.from_user.id == BOT_USER.id
-            
-            # Ovozli xabarda mention bo'lmaydi, faqat reply ga qarab ishlaymiz
-            if not is_reply_to_bot:
-                return
+        # Update stats — cache hit'da Whisper ishlamadi, hisoblagich oshmaydi
+        duration = voice.duration or 0
+        db.inc_user_counter(user_id, "n_transcribed_seconds", duration)
 
+    await message.reply(f"🎤 <i>{transcribed}</i>")
 
-    await process_message(message, text=transcribed)
+    await enqueue_message(message, text=transcribed)
 
 
 
@@ -1007,108 +1279,112 @@ async def generate_image(message: Message, prompt: str):
     """Rasm yaratish"""
     user_id = message.from_user.id
 
-    await bot.send_chat_action(chat_id=message.chat.id, action=ChatAction.UPLOAD_PHOTO)
-
-    try:
-        if config.image_provider == "gemini":
-            try:
-                image_urls = await gemini_utils.generate_images(prompt)
-            except Exception as e:
-                if "429" in str(e) or "RESOURCE_EXHAUSTED" in str(e):
-                    await message.answer("⚠️ Gemini limiti tugadi, DALL-E 3 ga o'tilmoqda...")
-                    image_urls = await openai_utils.generate_images(
-                        prompt,
-                        n_images=config.return_n_generated_images,
-                        size=config.image_size
-                    )
-                else:
-                    raise e
-        else:
-            image_urls = await openai_utils.generate_images(
-                prompt,
-                n_images=config.return_n_generated_images,
-                size=config.image_size
-            )
-
-    except Exception as e:
-        logger.error(f"Generate Image Error: {e}")
-        if "safety system" in str(e):
-            await message.answer("❌ So'rov xavfsizlik talablariga javob bermaydi")
-        elif "429" in str(e) or "RESOURCE_EXHAUSTED" in str(e):
-            await message.answer("⚠️ Google Gemini limiti (Quota) tugagan yoki bu model bepul tarifda mavjud emas.\nIltimos, DALL-E 3 ga o'ting.")
-        else:
-            await message.answer(f"❌ Xatolik: {str(e)[:200]}")
-        return
-
-    # Stats
-    current = db.get_user_attribute(user_id, "n_generated_images")
-    db.set_user_attribute(user_id, "n_generated_images", config.return_n_generated_images + current)
+    async with chat_action(message.chat.id, ChatAction.UPLOAD_PHOTO):
+        try:
+            if config.image_provider == "gemini":
+                try:
+                    image_urls = await gemini_utils.generate_images(prompt)
+                except Exception as e:
+                    if "429" in str(e) or "RESOURCE_EXHAUSTED" in str(e):
+                        await message.answer("⚠️ Gemini limiti tugadi, DALL-E 3 ga o'tilmoqda...")
+                        image_urls = await openai_utils.generate_images(
+                            prompt,
+                            n_images=config.return_n_generated_images,
+                            size=config.image_size
+                        )
+                    else:
+                        raise e
+            else:
+                image_urls = await openai_utils.generate_images(
+                    prompt,
+                    n_images=config.return_n_generated_images,
+                    size=config.image_size
+                )
 
-    for item in image_urls:
+        except Exception as e:
+            logger.error(f"Generate Image Error: {e}")
+            if "safety system" in str(e):
+                await message.answer("❌ So'rov xavfsizlik talablariga javob bermaydi")
+            elif "429" in str(e) or "RESOURCE_EXHAUSTED" in str(e):
+                await message.answer("⚠️ Google Gemini limiti (Quota) tugagan yoki bu model bepul tarifda mavjud emas.\nIltimos, DALL-E 3 ga o'ting.")
+            else:
+                await message.answer(f"❌ Xatolik: {str(e)[:200]}")
+            return
 
-        if isinstance(item, str):
-            await bot.send_photo(chat_id=message.chat.id, photo=item)
-        else:
-            item.seek(0)
-            input_file = BufferedInputFile(file=item.read(), filename="image.png")
-            await bot.send_photo(chat_id=message.chat.id, photo=input_file)
+        # Stats
+        db.inc_user_counter(user_id, "n_generated_images", config.return_n_generated_images)
 
+        # Yuborishlar parallel ketadi — N ta rasm ~bitta RTT'da
+        sends = []
+        for item in image_urls:
+            if isinstance(item, str):
+                sends.append(bot.send_photo(chat_id=message.chat.id, photo=item))
+            else:
+                item.seek(0)
+                input_file = BufferedInputFile(file=item.read(), filename="image.png")
+                sends.append(bot.send_photo(chat_id=message.chat.id, photo=input_file))
+
+        results = await asyncio.gather(*sends, return_exceptions=True)
+        for result in results:
+            if isinstance(result, Exception):
+                logger.error(f"Send photo error: {result}")
+
+
+
+# O'zgarmas system prompt — har chaqiriqda aynan bir xil prefiks ketadi,
+# OpenAI prompt caching shu prefiksni keshlaydi (mavzu alohida user xabarida)
+_PRESENTATION_SYSTEM_PROMPT = (
+    "Siz professional taqdimot mutaxassisisiz. Foydalanuvchi bergan mavzuga asoslanib, slaydlar mazmunini tayyorlang.\n\n"
+    "Talab: Javobni FAQAT quyidagi JSON formatda qaytaring (hech qanday markdown, ```json``` yoki qo'shimcha so'zlar bo'lmasin, faqat toza JSON matni):\n"
+    "[\n"
+    '  {"title": "Taqdimot Sarlavhasi", "content": "Kirish so\'zlari..."},\n'
+    '  {"title": "1-slayd sarlavhasi", "content": "- Asosoiy fikr 1\\n- Asosiy fikr 2"},\n'
+    "  ...\n"
+    "]\n"
+    "Kamida 5 ta slayd bo'lsin. Til: O'zbek tili (yoki so'rov tilida)."
+)
 
 
 async def generate_presentation_handler(message: Message, prompt: str):
     """Presentatsiya yaratish"""
     user_id = message.from_user.id
-    current_model = db.get_user_attribute(user_id, "current_model")
-
-    # Promptni tayyorlash
-    system_prompt = (
-        f"Siz professional taqdimot mutaxassisisiz. Foydalanuvchi so'roviga asoslanib, slaydlar mazmunini tayyorlang.\n"
-        f"Mavzu: {prompt}\n\n"
-        f"Talab: Javobni FAQAT quyidagi JSON formatda qaytaring (hech qanday markdown, ```json``` yoki qo'shimcha so'zlar bo'lmasin, faqat toza JSON matni):\n"
-        f"[\n"
-        f'  {{"title": "Taqdimot Sarlavhasi", "content": "Kirish so\'zlari..."}},\n'
-        f'  {{"title": "1-slayd sarlavhasi", "content": "- Asosoiy fikr 1\\n- Asosiy fikr 2"}},\n'
-        f"  ...\n"
-        f"]\n"
-        f"Kamida 5 ta slayd bo'lsin. Til: O'zbek tili (yoki so'rov tilida)."
-    )
+    current_model = await db.get_user_attribute(user_id, "current_model")
 
     try:
-        await bot.send_chat_action(chat_id=message.chat.id, action=ChatAction.UPLOAD_DOCUMENT)
-        
-        # Biz dialog tarixini yubormaymiz, faqat shuni so'raymiz
-        messages = [{"role": "system", "content": system_prompt}]
-        
-        response = await openai_utils.client.chat.completions.create(
-            model="gpt-3.5-turbo", # JSON uchun gpt-3.5 yetarli va tezroq
-            messages=messages,
-            temperature=0.7
-        )
-        
-        answer = response.choices[0].message.content
-        
-        # JSON tozalash (ba'zan ```json ... ``` keladi)
-        if "```json" in answer:
-            answer = answer.split("```json")[1].split("```")[0]
-        elif "```" in answer:
-            answer = answer.split("```")[1].split("```")[0]
-            
-        slides_data = json.loads(answer.strip())
-        
-        if not isinstance(slides_data, list):
-            raise ValueError("GPT JSON ro'yxat qaytarmadi")
+        async with chat_action(message.chat.id, ChatAction.UPLOAD_DOCUMENT):
+            # Biz dialog tarixini yubormaymiz, faqat shuni so'raymiz
+            messages = [
+                {"role": "system", "content": _PRESENTATION_SYSTEM_PROMPT},
+                {"role": "user", "content": f"Mavzu: {prompt}"},
+            ]
+
+            response = await openai_utils.client.chat.completions.create(
+                model="gpt-3.5-turbo", # JSON uchun gpt-3.5 yetarli va tezroq
+                messages=messages,
+                temperature=0.7
+            )
 
-        # PPTX yaratish
-        ppt_buffer = await pptx_utils.create_presentation(prompt[:50], slides_data)
-        
-        if ppt_buffer:
-            from aiogram.types import BufferedInputFile
-            input_file = BufferedInputFile(ppt_buffer.getvalue(), filename=ppt_buffer.name)
-            await message.answer_document(document=input_file, caption="✅ <b>Presentatsiya tayyor!</b>")
-        else:
-            await message.answer("❌ Fayl yaratishda xatolik bo'ldi.")
+            answer = response.choices[0].message.content
 
-    except json.JSONDecodeError:
+            # JSON tozalash (ba'zan ```json ... ``` keladi) — massivni bitta regex bilan topamiz
+            m = _JSON_ARRAY_RE.search(answer)
+            slides_data = orjson.loads(m.group(0) if m else answer.strip())
+
+            if not isinstance(slides_data, list):
+                raise ValueError("GPT JSON ro'yxat qaytarmadi")
+
+            # PPTX yaratish — python-pptx (lxml bilan) faqat shu yerda kerak,
+            # import birinchi chaqiriqda bo'ladi va keyin modul keshida turadi
+            import pptx_utils
+            ppt_buffer = await pptx_utils.create_presentation(prompt[:50], slides_data)
+
+            if ppt_buffer:
+                input_file = BufferedInputFile(ppt_buffer.getvalue(), filename=ppt_buffer.name)
+                await message.answer_document(document=input_file, caption="✅ <b>Presentatsiya tayyor!</b>")
+            else:
+                await message.answer("❌ Fayl yaratishda xatolik bo'ldi.")
+
+    except orjson.JSONDecodeError:
         logger.error(f"JSON Error: {answer}")
         await message.answer("❌ GPT javobini o'qib bo'lmadi (JSON error). Qaytadan urinib ko'ring.")
     except Exception as e:
@@ -1132,37 +1408,97 @@ async def set_commands():
     ]
     await bot.set_my_commands(commands)
 
+async def run_webhook():
+    """Webhook rejimi: Telegram'ga darhol 200 qaytarib, update'ni background'da ishlash"""
+    from urllib.parse import urlparse
+
+    from aiohttp import web
+    from aiogram.types import Update
+
+    webhook_path = urlparse(config.webhook_url).path or "/webhook"
+
+    async def handle_update(request: web.Request) -> web.Response:
+        if config.webhook_secret:
+            if request.headers.get("X-Telegram-Bot-Api-Secret-Token") != config.webhook_secret:
+                return web.Response(status=403)
+
+        data = await request.json()
+        update = Update.model_validate(data, context={"bot": bot})
+        # Javobni kutmasdan darhol ack qilamiz — Telegram retry qilmasligi uchun
+        asyncio.create_task(dp.feed_update(bot, update))
+        return web.Response()
+
+    await bot.set_webhook(
+        config.webhook_url,
+        secret_token=config.webhook_secret,
+        drop_pending_updates=True,
+        allowed_updates=dp.resolve_used_update_types(),
+    )
+
+    app = web.Application()
+    app.router.add_post(webhook_path, handle_update)
+
+    runner = web.AppRunner(app)
+    await runner.setup()
+    site = web.TCPSite(runner, "0.0.0.0", config.webhook_port)
+    await site.start()
+    logger.info(f"Webhook server listening on :{config.webhook_port}{webhook_path}")
+
+    await asyncio.Event().wait()
+
+
 async def main():
+    router.message.outer_middleware(AccessMiddleware())
+    router.callback_query.outer_middleware(AccessMiddleware())
     dp.include_router(router)
-    global BOT_USER
+    global BOT_USER, BOT_ID, BOT_MENTION
     BOT_USER = await bot.get_me()
+    BOT_ID = BOT_USER.id
+    BOT_MENTION = "@" + (BOT_USER.username or "")
     await set_commands()
+    await db.ensure_indexes()
+
+    asyncio.create_task(user_locks.sweeper())
+    asyncio.create_task(db.interaction_flusher())
+    for _ in range(N_MESSAGE_WORKERS):
+        asyncio.create_task(message_worker())
 
     try:
-        await dp.start_polling(
-            bot, 
-            allowed_updates=dp.resolve_used_update_types(),
-            polling_timeout=20,
-            handle_signals=True,
-            drop_pending_updates=True,
-            backoff_config=BackoffConfig(
-                min_delay=1.0,
-                max_delay=60.0,
-                factor=1.3,
-                jitter=0.1
+        if config.webhook_url:
+            await run_webhook()
+        else:
+            await dp.start_polling(
+                bot,
+                allowed_updates=dp.resolve_used_update_types(),
+                # uzunroq long-poll — bo'sh botda getUpdates RTT'lari kamayadi
+                polling_timeout=30,
+                handle_signals=True,
+                drop_pending_updates=True,
+                backoff_config=BackoffConfig(
+                    min_delay=1.0,
+                    max_delay=60.0,
+                    factor=1.3,
+                    jitter=0.1
+                )
             )
-        )
     except Exception as e:
         logger.error(f"Fatal error in polling: {e}", exc_info=True)
     finally:
         await bot.session.close()
 
 if __name__ == "__main__":
+    # uvloop bo'lsa ishlatamiz — handlerlar to'liq I/O-bound, event loop
+    # overhead'i pasayadi (Windows'da va o'rnatilmagan bo'lsa stdlib loop qoladi)
+    try:
+        import uvloop
+        asyncio.set_event_loop_policy(uvloop.EventLoopPolicy())
+    except ImportError:
+        pass
+
     try:
         asyncio.run(main())
         logger.info("✅ Bot ishga tushdi!")       
     except KeyboardInterrupt:
         logger.info("👋 Bot to'xtatildi (Ctrl+C)")
-    except Exception as e:
-        logger.error(f"❌ Bot ishga tushmadi: {e}")
-        logger.error(traceback.format_exc())
\ No newline at end of file
+    except Exception:
+        logger.exception("❌ Bot ishga tushmadi")
\ No newline at end of file
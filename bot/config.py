@@ -1,6 +1,7 @@
 import yaml
 import os
 from pathlib import Path
+from types import MappingProxyType, SimpleNamespace
 from dotenv import load_dotenv
 
 config_dir = Path(__file__).parent.parent.resolve() / "config"
@@ -29,16 +30,36 @@ if not openai_api_key:
 
 # Config parameters
 openai_api_base = config_yaml.get("openai_api_base", None)
-allowed_telegram_usernames = config_yaml.get("allowed_telegram_usernames", [])
+# Ruxsat ro'yxati bitta o'tishda ikkiga ajratiladi: int'lar user id,
+# str'lar username (@'siz, kichik harfda) — har xabardagi tekshiruv O(1)
+_allowed_user_ids = []
+_allowed_usernames = []
+for _entry in config_yaml.get("allowed_telegram_usernames", []) or []:
+    if isinstance(_entry, str):
+        _allowed_usernames.append(_entry.lstrip("@").lower())
+    else:
+        _allowed_user_ids.append(_entry)
+allowed_user_ids = frozenset(_allowed_user_ids)
+allowed_usernames = frozenset(_allowed_usernames)
+# bo'sh ro'yxat — bot hamma uchun ochiq
+access_restricted = bool(allowed_user_ids or allowed_usernames)
 new_dialog_timeout = config_yaml.get("new_dialog_timeout", 600)
 enable_message_streaming = config_yaml.get("enable_message_streaming", True)
 return_n_generated_images = config_yaml.get("return_n_generated_images", 1)
 image_size = config_yaml.get("image_size", "1024x1024")
 n_chat_modes_per_page = config_yaml.get("n_chat_modes_per_page", 5)
+# bitta xabarni qayta ishlashga beriladigan maksimal vaqt (lock shu muddatdan
+# ko'p ushlab turilmaydi — osilib qolgan OpenAI chaqirig'i userni qulflab qo'ymasin)
+processing_timeout = config_yaml.get("processing_timeout", 300)
 
 image_provider = config_yaml.get("image_provider", "dall-e-3")
 google_api_key = os.getenv("GOOGLE_API_KEY") or config_yaml.get("google_api_key", None)
 
+# Webhook (bo'sh bo'lsa long-polling ishlatiladi)
+webhook_url = os.getenv("WEBHOOK_URL") or config_yaml.get("webhook_url", None)
+webhook_secret = os.getenv("WEBHOOK_SECRET") or config_yaml.get("webhook_secret", None)
+webhook_port = int(os.getenv("WEBHOOK_PORT") or config_yaml.get("webhook_port", 8080))
+
 
 
 
@@ -53,10 +74,15 @@ if not mongodb_uri:
 with open(config_dir / "chat_modes.yml", 'r') as f:
     chat_modes = yaml.safe_load(f)
 
+# Atribut orqali o'qiladigan muzlatilgan ko'rinish: hot path'da dict-of-dict
+# lookup'lar o'rniga attribute access, noto'g'ri kalit esa startup'dayoq chiqadi
+chat_modes = MappingProxyType({k: SimpleNamespace(**v) for k, v in chat_modes.items()})
+
 # Load models
 with open(config_dir / "models.yml", 'r') as f:
     models = yaml.safe_load(f)
     available_text_models = models["available_text_models"]
+    models["info"] = MappingProxyType({k: SimpleNamespace(**v) for k, v in models["info"].items()})
 
 # Files
 help_group_chat_video_path = Path(__file__).parent.parent.resolve() / "static" / "help_group_chat.mp4"
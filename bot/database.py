@@ -1,22 +1,90 @@
 from typing import Optional, Any
 
+import asyncio
+import logging
 import pymongo
+import time
 import uuid
+from collections import OrderedDict
 from datetime import datetime
 
+from motor.motor_asyncio import AsyncIOMotorClient
+
 import config
 
+# user hujjati sxemasining joriy versiyasi — migratsiya bloklari shu raqamga qarab o'tkazib yuboriladi
+SCHEMA_VERSION = 2
+
+# user cache yozuvining yashash muddati — tashqi o'zgarishlar (admin, migratsiya)
+# ko'pi bilan shuncha vaqtdan keyin ko'rinadi
+USER_CACHE_TTL = 60.0
+
+# nechta user hujjati xotirada saqlanadi (LRU) — ochiq botda chegarasiz o'smasin
+USER_CACHE_MAX = 10_000
+
+# nechta dialogning messages ro'yxati xotirada saqlanadi (LRU)
+DIALOG_CACHE_MAX = 256
+
 class Database:
     def __init__(self):
-        self.client = pymongo.MongoClient(config.mongodb_uri)
+        # kattaroq pool — parallel userlarda so'rovlar bitta socket navbatida turmasin
+        self.client = AsyncIOMotorClient(config.mongodb_uri, maxPoolSize=50)
         self.db = self.client["chat_gpt_telegram_bot"]
 
         self.user_collection = self.db["user"]
         self.dialog_collection = self.db["dialog"]
         # self.allowed_users_collection = self.db["allowed_users"]
 
-    def check_if_user_exists(self, user_id: int, raise_exception: bool = False):
-        if self.user_collection.count_documents({"_id": user_id}) > 0:
+        # in-process cache of user documents (write-through, one read per user)
+        self.user_cache: OrderedDict[int, dict] = OrderedDict()
+        self.user_cache_at: dict[int, float] = {}
+
+        # last_interaction yozuvlari davriy bulk_write bilan yuboriladi
+        self._pending_interactions: dict[int, datetime] = {}
+
+        # faol dialoglarning messages ro'yxati — har turda Mongo'dan qayta o'qilmasin
+        self._dialog_cache: OrderedDict[tuple, list] = OrderedDict()
+
+    async def ensure_indexes(self):
+        await self.dialog_collection.create_index([("user_id", pymongo.ASCENDING), ("start_time", pymongo.ASCENDING)])
+
+    async def _fetch_user(self, user_id: int) -> Optional[dict]:
+        """Userni cache'dan olish, muddati o'tgan yoki yo'q bo'lsa bitta find_one bilan yuklash"""
+        user_dict = self.user_cache.get(user_id)
+        if user_dict is not None and time.monotonic() - self.user_cache_at.get(user_id, 0.0) < USER_CACHE_TTL:
+            self.user_cache.move_to_end(user_id)
+            return user_dict
+
+        fresh = await self.user_collection.find_one({"_id": user_id})
+        if fresh is not None:
+            self._cache_user(user_id, fresh)
+            return fresh
+
+        self.user_cache.pop(user_id, None)
+        self.user_cache_at.pop(user_id, None)
+        return None
+
+    def _schedule_write(self, coro):
+        """Mongo yozuvni handler kutmasligi uchun background task sifatida yuborish"""
+        asyncio.create_task(coro)
+
+    def _cache_user(self, user_id: int, user_dict: dict):
+        self.user_cache[user_id] = user_dict
+        self.user_cache.move_to_end(user_id)
+        self.user_cache_at[user_id] = time.monotonic()
+        while len(self.user_cache) > USER_CACHE_MAX:
+            old_id, _ = self.user_cache.popitem(last=False)
+            self.user_cache_at.pop(old_id, None)
+
+    def _cache_dialog(self, user_id: int, dialog_id: str, messages: list):
+        key = (user_id, dialog_id)
+        self._dialog_cache[key] = messages
+        self._dialog_cache.move_to_end(key)
+        while len(self._dialog_cache) > DIALOG_CACHE_MAX:
+            self._dialog_cache.popitem(last=False)
+
+    async def check_if_user_exists(self, user_id: int, raise_exception: bool = False):
+        if await self._fetch_user(user_id) is not None:
             return True
         else:
             if raise_exception:
@@ -24,7 +92,7 @@ class Database:
             else:
                 return False
 
-    def add_new_user(
+    async def add_new_user(
         self,
         user_id: int,
         chat_id: int,
@@ -50,84 +118,199 @@ class Database:
             "n_used_tokens": {},
 
             "n_generated_images": 0,
-            "n_transcribed_seconds": 0.0  # voice message transcription
+            "n_transcribed_seconds": 0.0,  # voice message transcription
+
+            "schema_version": SCHEMA_VERSION,
         }
 
-        if not self.check_if_user_exists(user_id):
-            self.user_collection.insert_one(user_dict)
+        # check+insert o'rniga bitta atomik upsert — mavjud user o'zgarmaydi
+        result = await self.user_collection.update_one(
+            {"_id": user_id}, {"$setOnInsert": user_dict}, upsert=True
+        )
+        if result.upserted_id is not None:
+            self._cache_user(user_id, user_dict)
 
-    def start_new_dialog(self, user_id: int):
-        self.check_if_user_exists(user_id, raise_exception=True)
+    async def start_new_dialog(self, user_id: int):
+        # mavjudlik tekshiruvi + ikkala atribut bitta cached o'qishda
+        # (user yo'q bo'lsa ValueError shu yerdan chiqadi)
+        attrs = await self.get_user_attributes_bulk(user_id, ["current_chat_mode", "current_model"])
 
         dialog_id = str(uuid.uuid4())
         dialog_dict = {
             "_id": dialog_id,
             "user_id": user_id,
-            "chat_mode": self.get_user_attribute(user_id, "current_chat_mode"),
+            "chat_mode": attrs["current_chat_mode"],
             "start_time": datetime.now(),
-            "model": self.get_user_attribute(user_id, "current_model"),
+            "model": attrs["current_model"],
             "messages": []
         }
 
         # add new dialog
-        self.dialog_collection.insert_one(dialog_dict)
+        await self.dialog_collection.insert_one(dialog_dict)
 
-        # update user's current dialog
-        self.user_collection.update_one(
-            {"_id": user_id},
-            {"$set": {"current_dialog_id": dialog_id}}
-        )
+        # update user's current dialog — cache darhol, Mongo yozuvi fonda
+        self.set_user_attribute(user_id, "current_dialog_id", dialog_id)
 
+        self._cache_dialog(user_id, dialog_id, [])
         return dialog_id
 
-    def get_user_attribute(self, user_id: int, key: str):
-        self.check_if_user_exists(user_id, raise_exception=True)
-        user_dict = self.user_collection.find_one({"_id": user_id})
+    async def get_user_attribute(self, user_id: int, key: str):
+        user_dict = await self._fetch_user(user_id)
+        if user_dict is None:
+            raise ValueError(f"User {user_id} does not exist")
 
         if key not in user_dict:
             return None
 
         return user_dict[key]
 
+    async def get_user_attributes_bulk(self, user_id: int, keys: list) -> dict:
+        """Bir nechta atributni bitta o'qish bilan olish (yo'q kalitlar None bo'ladi)"""
+        user_dict = await self._fetch_user(user_id)
+        if user_dict is None:
+            raise ValueError(f"User {user_id} does not exist")
+
+        return {key: user_dict.get(key) for key in keys}
+
     def set_user_attribute(self, user_id: int, key: str, value: Any):
-        self.check_if_user_exists(user_id, raise_exception=True)
-        self.user_collection.update_one({"_id": user_id}, {"$set": {key: value}})
+        # write-through: cache first, Mongo write in background
+        user_dict = self.user_cache.get(user_id)
+        if user_dict is not None:
+            user_dict[key] = value
+            # yozuv cache'ni yangilaydi — TTL ham shu yerdan qayta hisoblanadi,
+            # aks holda muddati o'tganda fonda ketayotgan yozuvdan eski hujjat o'qiladi
+            self.user_cache_at[user_id] = time.monotonic()
+
+        self._schedule_write(
+            self.user_collection.update_one({"_id": user_id}, {"$set": {key: value}})
+        )
 
-    def update_n_used_tokens(self, user_id: int, model: str, n_input_tokens: int, n_output_tokens: int):
-        n_used_tokens_dict = self.get_user_attribute(user_id, "n_used_tokens")
-        if n_used_tokens_dict is None:
-            n_used_tokens_dict = {}
+    def set_user_attributes(self, user_id: int, values: dict):
+        """Bir nechta atributni bitta $set bilan yozish (alohida round-trip'larsiz)"""
+        user_dict = self.user_cache.get(user_id)
+        if user_dict is not None:
+            user_dict.update(values)
+            self.user_cache_at[user_id] = time.monotonic()
 
-        if model in n_used_tokens_dict:
-            n_used_tokens_dict[model]["n_input_tokens"] += n_input_tokens
-            n_used_tokens_dict[model]["n_output_tokens"] += n_output_tokens
-        else:
-            n_used_tokens_dict[model] = {
-                "n_input_tokens": n_input_tokens,
-                "n_output_tokens": n_output_tokens
-            }
+        self._schedule_write(
+            self.user_collection.update_one({"_id": user_id}, {"$set": values})
+        )
 
-        self.set_user_attribute(user_id, "n_used_tokens", n_used_tokens_dict)
+    def bulk_update_user(self, user_id: int, inc: Optional[dict] = None, set_values: Optional[dict] = None):
+        """$inc va $set'larni bitta update_one'ga jamlab yuborish"""
+        update = {}
+        if inc:
+            update["$inc"] = inc
+        if set_values:
+            update["$set"] = set_values
+            user_dict = self.user_cache.get(user_id)
+            if user_dict is not None:
+                user_dict.update(set_values)
+                self.user_cache_at[user_id] = time.monotonic()
+        if not update:
+            return
+
+        self._schedule_write(self.user_collection.update_one({"_id": user_id}, update))
 
-    def get_dialog_messages(self, user_id: int, dialog_id: Optional[str] = None):
-        self.check_if_user_exists(user_id, raise_exception=True)
+    def update_n_used_tokens(self, user_id: int, model: str, n_input_tokens: int, n_output_tokens: int):
+        # bitta atomik $inc — fetch+modify raundlarisiz, parallel xabarlarda ham yo'qolmaydi
+        self.bulk_update_user(user_id, inc={
+            f"n_used_tokens.{model}.n_input_tokens": n_input_tokens,
+            f"n_used_tokens.{model}.n_output_tokens": n_output_tokens,
+        })
+
+        user_dict = self.user_cache.get(user_id)
+        if user_dict is not None:
+            if not user_dict.get("n_used_tokens"):
+                user_dict["n_used_tokens"] = {}
+            model_tokens = user_dict["n_used_tokens"].setdefault(
+                model, {"n_input_tokens": 0, "n_output_tokens": 0}
+            )
+            model_tokens["n_input_tokens"] += n_input_tokens
+            model_tokens["n_output_tokens"] += n_output_tokens
+
+    def touch(self, user_id: int):
+        """last_interaction'ni darhol cache'da yangilab, Mongo yozuvini flush'ga qoldirish"""
+        now = datetime.now()
+        user_dict = self.user_cache.get(user_id)
+        if user_dict is not None:
+            user_dict["last_interaction"] = now
+            self.user_cache_at[user_id] = time.monotonic()
+        self._pending_interactions[user_id] = now
+
+    async def flush_interactions(self):
+        if not self._pending_interactions:
+            return
+        pending, self._pending_interactions = self._pending_interactions, {}
+        await self.user_collection.bulk_write(
+            [
+                pymongo.UpdateOne({"_id": uid}, {"$set": {"last_interaction": ts}})
+                for uid, ts in pending.items()
+            ],
+            ordered=False,
+        )
 
+    async def interaction_flusher(self, interval: float = 10):
+        """To'plangan last_interaction'larni har necha soniyada bitta bulk_write bilan yozish"""
+        while True:
+            await asyncio.sleep(interval)
+            try:
+                await self.flush_interactions()
+            except Exception:
+                logging.getLogger(__name__).exception("last_interaction flush failed")
+
+    def inc_user_counter(self, user_id: int, key: str, amount):
+        """Oddiy hisoblagichni (rasm/soniya) atomik $inc bilan oshirish"""
+        user_dict = self.user_cache.get(user_id)
+        if user_dict is not None:
+            user_dict[key] = (user_dict.get(key) or 0) + amount
+
+        self._schedule_write(
+            self.user_collection.update_one({"_id": user_id}, {"$inc": {key: amount}})
+        )
+
+    async def get_dialog_messages(self, user_id: int, dialog_id: Optional[str] = None):
         if dialog_id is None:
-            dialog_id = self.get_user_attribute(user_id, "current_dialog_id")
+            dialog_id = await self.get_user_attribute(user_id, "current_dialog_id")
 
-        dialog_dict = self.dialog_collection.find_one({"_id": dialog_id, "user_id": user_id})
-        return dialog_dict["messages"]
+        cached = self._dialog_cache.get((user_id, dialog_id))
+        if cached is not None:
+            self._dialog_cache.move_to_end((user_id, dialog_id))
+            # nusxa qaytariladi — chaqiruvchi ro'yxatni qisqartirsa cache buzilmasin
+            return list(cached)
 
-    def set_dialog_messages(self, user_id: int, dialog_messages: list, dialog_id: Optional[str] = None):
-        self.check_if_user_exists(user_id, raise_exception=True)
+        # faqat messages maydoni kerak — metadata har turda qayta tashilmasin
+        dialog_dict = await self.dialog_collection.find_one(
+            {"_id": dialog_id, "user_id": user_id},
+            {"messages": 1, "_id": 0},
+        )
+        messages = dialog_dict["messages"]
+        self._cache_dialog(user_id, dialog_id, list(messages))
+        return messages
 
+    async def set_dialog_messages(self, user_id: int, dialog_messages: list, dialog_id: Optional[str] = None):
         if dialog_id is None:
-            dialog_id = self.get_user_attribute(user_id, "current_dialog_id")
+            dialog_id = await self.get_user_attribute(user_id, "current_dialog_id")
 
-        self.dialog_collection.update_one(
+        await self.dialog_collection.update_one(
             {"_id": dialog_id, "user_id": user_id},
             {"$set": {"messages": dialog_messages}}
         )
+        self._cache_dialog(user_id, dialog_id, list(dialog_messages))
+
+    async def append_dialog_message(self, user_id: int, new_message: dict, dialog_id: Optional[str] = None):
+        """Bitta $push bilan yangi xabarni qo'shish (to'liq ro'yxatni qayta yozmasdan)"""
+        if dialog_id is None:
+            dialog_id = await self.get_user_attribute(user_id, "current_dialog_id")
+
+        await self.dialog_collection.update_one(
+            {"_id": dialog_id, "user_id": user_id},
+            {"$push": {"messages": new_message}}
+        )
+        cached = self._dialog_cache.get((user_id, dialog_id))
+        if cached is not None:
+            cached.append(new_message)
+            self._dialog_cache.move_to_end((user_id, dialog_id))
 
     # def add_allowed_user(
     #     self,
@@ -147,7 +330,7 @@ class Database:
 
     #     self.allowed_users_collection.insert_one(user_dict)
     #     return True
-    
+
     # def remove_allowed_user(self, username: str):
     #     result = self.allowed_users_collection.delete_one({"username": username})
     #     return result.deleted_count > 0
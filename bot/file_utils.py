@@ -4,15 +4,44 @@ from pypdf import PdfReader
 from docx import Document as DocxDocument
 import os
 
+# PyMuPDF (C kutubxona) pypdf'dan bir necha barobar tez — bo'lsa shuni ishlatamiz
+try:
+    import fitz
+except ImportError:
+    fitz = None
+
 logger = logging.getLogger(__name__)
 
-def extract_text(file_buffer: io.BytesIO, extension: str) -> str:
+# Matn branch'i uchun yuqori chegara — ulkan "soxta .txt" fayl ulkan str bo'lib ketmasin
+MAX_TEXT_BYTES = 10 * 1024 * 1024
+
+# Matn/kod fayllari kengaytmalari — har chaqiriqda ro'yxat qayta qurilmasin
+TEXT_EXTS = frozenset([
+    "txt", "py", "js", "html", "css", "json", "md", "yml", "yaml", "xml",
+    "csv", "sh", "sql", "java", "cpp", "c", "h", "cs",
+])
+
+def extract_text(file_buffer, extension: str) -> str:
     """Faylni o'qib matnini ajratib olish (Pdf, Docx, Text, Code)"""
     text = ""
     extension = extension.lower().strip('.')
-    
+
+    # Telegram'da kengaytma ko'pincha yo'q yoki noto'g'ri — magic baytlar ustun turadi
+    file_buffer.seek(0)
+    head = file_buffer.read(8)
+    file_buffer.seek(0)
+    if head.startswith(b"%PDF"):
+        extension = "pdf"
+    elif head.startswith(b"PK\x03\x04") and extension not in ("docx", "doc"):
+        extension = "docx"
+
     try:
         if extension == "pdf":
+            if fitz is not None:
+                file_buffer.seek(0)
+                with fitz.open(stream=file_buffer.read(), filetype="pdf") as doc:
+                    return "\n".join(page.get_text() for page in doc).strip()
+
             reader = PdfReader(file_buffer)
             if reader.is_encrypted:
                 try:
@@ -20,31 +49,31 @@ def extract_text(file_buffer: io.BytesIO, extension: str) -> str:
                 except:
                     pass
             
+            # str += o'rniga sahifalar ro'yxati + join — katta PDF'da kvadratik ko'chirish bo'lmasin
+            parts = []
             for page in reader.pages:
                 try:
                     extracted = page.extract_text()
                     if extracted:
-                        text += extracted + "\n"
+                        parts.append(extracted)
                 except Exception as e:
                     logger.warning(f"Error extracting PDF page: {e}")
+            text = "\n".join(parts)
 
         
         elif extension in ["docx", "doc"]:
             doc = DocxDocument(file_buffer)
-            for para in doc.paragraphs:
-                text += para.text + "\n"
+            text = "\n".join(para.text for para in doc.paragraphs)
         
         # Text and Code files
-        elif extension in ["txt", "py", "js", "html", "css", "json", "md", "yml", "yaml", "xml", "csv", "sh", "sql", "java", "cpp", "c", "h", "cs"]:
-            try:
-                # Try UTF-8 first
-                text = file_buffer.getvalue().decode('utf-8')
-            except UnicodeDecodeError:
-                # Try latin-1 fallback
-                try:
-                    text = file_buffer.getvalue().decode('latin-1')
-                except:
-                    return None
+        elif extension in TEXT_EXTS:
+            file_buffer.seek(0, io.SEEK_END)
+            if file_buffer.tell() > MAX_TEXT_BYTES:
+                logger.warning(f"Text file too large to extract ({file_buffer.tell()} bytes)")
+                return None
+            file_buffer.seek(0)
+            # bitta decode, istisnolarsiz — noto'g'ri baytlar � bilan almashtiriladi
+            text = file_buffer.read().decode('utf-8', errors='replace')
         
         else:
             return None # Qo'llab-quvvatlanmaydigan format
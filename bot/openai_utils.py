@@ -1,19 +1,60 @@
+import asyncio
 import base64
+import functools
+import time
 from io import BytesIO
 import config
 import logging
 
+import httpx
 import tiktoken
 from openai import AsyncOpenAI
 
+# Umumiy keep-alive connection pool — har chaqiriqda TCP+TLS qayta ochilmasligi uchun.
+# HTTP/2 bitta ulanishda parallel so'rovlarni multiplex qiladi (kamroq TLS handshake)
+http_client = httpx.AsyncClient(
+    http2=True,
+    limits=httpx.Limits(
+        max_connections=200,
+        max_keepalive_connections=50,
+        keepalive_expiry=75,
+    ),
+    timeout=httpx.Timeout(60.0, connect=10.0),
+)
+
 # Setup OpenAI client
 client = AsyncOpenAI(
     api_key=config.openai_api_key,
-    base_url=config.openai_api_base if config.openai_api_base else None
+    base_url=config.openai_api_base if config.openai_api_base else None,
+    http_client=http_client,
 )
 
 logger = logging.getLogger(__name__)
 
+
+@functools.lru_cache(maxsize=8)
+def _get_encoding(model: str):
+    """Model tokenizer'i bir marta yuklanadi — har chaqiriqda BPE lookup qilinmaydi
+
+    Hisoblashda encode_ordinary ishlatiladi: special-token skaneri shart emas,
+    oddiy matn ustida ancha tezroq.
+    """
+    if model.startswith("gpt-5"):
+        return tiktoken.get_encoding("cl100k_base")
+    return tiktoken.encoding_for_model(model)
+
+def _extract_user_text(user) -> str:
+    """Saqlangan user kontentidan (str yoki strukturali ro'yxat) matnni olish"""
+    if isinstance(user, str):
+        return user
+    if isinstance(user, list):
+        for item in user:
+            if item.get("type") == "text":
+                return item.get("text", "") or "[Image message]"
+        return "[Image message]"
+    return str(user)
+
+
 OTHER_MODEL_OPTIONS = {
     "temperature": 0.7,
     "max_tokens": 2048,
@@ -25,6 +66,17 @@ GPT5_OPTIONS = {
     "reasoning_effort": "medium",
 }
 
+# Modellarning kontekst oynalari — kontekst xatosida lokal trim uchun
+MODEL_CONTEXT = {
+    "gpt-5.1": 128_000,
+    "gpt-4-turbo-preview": 128_000,
+    "gpt-4": 8_192,
+    "gpt-4o": 128_000,
+    "gpt-4o-mini": 128_000,
+    "gpt-3.5-turbo-16k": 16_384,
+    "gpt-3.5-turbo": 16_385,
+}
+
 
 class ChatGPT:
     def _get_options(self):
@@ -72,7 +124,7 @@ class ChatGPT:
                 if "maximum context length" in error_str or "context_length_exceeded" in error_str:
                     if len(dialog_messages) == 0:
                         raise ValueError("Dialog messages is reduced to zero, but still has too many tokens") from e
-                    dialog_messages = dialog_messages[1:]
+                    self._drop_oldest_to_fit(dialog_messages, messages)
                 else:
                     raise
 
@@ -90,6 +142,12 @@ class ChatGPT:
             try:
                 messages = self._generate_prompt_messages(message, dialog_messages, chat_mode)
 
+                # prompt bir marta sanaladi; chiqish tokenlari delta bo'yicha yig'iladi —
+                # aks holda har chunkda butun tarix + javob qayta enkod bo'lardi (O(N^2))
+                encoding = _get_encoding(self.model)
+                n_input_tokens = self._count_input_tokens(messages, model=self.model)
+                n_output_tokens = 1
+
                 stream = await client.chat.completions.create(
                     model=self.model,
                     messages=messages,
@@ -98,23 +156,33 @@ class ChatGPT:
                 )
 
                 answer = ""
+                # str += o'rniga fragmentlar ro'yxati — join faqat yield paytida
+                answer_parts = []
+                last_yield = time.monotonic()
+                pending_len = 0
                 async for chunk in stream:
-                    if chunk.choices[0].delta.content:
-                        answer += chunk.choices[0].delta.content
-                        n_input_tokens, n_output_tokens = self._count_tokens_from_messages(
-                            messages, answer, model=self.model
-                        )
+                    delta = chunk.choices[0].delta.content
+                    if delta:
+                        answer_parts.append(delta)
+                        n_output_tokens += len(encoding.encode_ordinary(delta))
+                        # mayda deltalarni jamlaymiz — iste'molchi har 1-3 belgida uyg'onmasin
+                        pending_len += len(delta)
+                        if pending_len < 40 and time.monotonic() - last_yield < 0.05:
+                            continue
+                        answer = "".join(answer_parts)
                         n_first_dialog_messages_removed = 0
                         yield "not_finished", answer, (n_input_tokens, n_output_tokens), n_first_dialog_messages_removed
+                        pending_len = 0
+                        last_yield = time.monotonic()
 
-                answer = self._postprocess_answer(answer)
+                answer = self._postprocess_answer("".join(answer_parts))
 
             except Exception as e:
                 error_str = str(e)
                 if "maximum context length" in error_str or "context_length_exceeded" in error_str:
                     if len(dialog_messages) == 0:
                         raise
-                    dialog_messages = dialog_messages[1:]
+                    self._drop_oldest_to_fit(dialog_messages, messages)
                 else:
                     raise
 
@@ -127,14 +195,20 @@ class ChatGPT:
         dialog_messages=[],
         chat_mode="assistant",
         image_buffer: BytesIO = None,
+        image_url: str = None,
     ):
         n_dialog_messages_before = len(dialog_messages)
         answer = None
-        
+
+        # buffer berilsa base64 threadda bir marta ishlanadi; URL bo'lsa API o'zi yuklab oladi
+        if image_buffer is not None:
+            encoded_image = await asyncio.to_thread(self._encode_image, image_buffer)
+            image_url = f"data:image/jpeg;base64,{encoded_image}"
+
         while answer is None:
             try:
                 messages = self._generate_prompt_messages(
-                    message, dialog_messages, chat_mode, image_buffer
+                    message, dialog_messages, chat_mode, image_url
                 )
                 
                 response = await client.chat.completions.create(
@@ -153,7 +227,7 @@ class ChatGPT:
                 if "maximum context length" in error_str or "context_length_exceeded" in error_str:
                     if len(dialog_messages) == 0:
                         raise ValueError("Dialog messages reduced to zero") from e
-                    dialog_messages = dialog_messages[1:]
+                    self._drop_oldest_to_fit(dialog_messages, messages)
                 else:
                     raise
 
@@ -166,16 +240,25 @@ class ChatGPT:
         dialog_messages=[],
         chat_mode="assistant",
         image_buffer: BytesIO = None,
+        image_url: str = None,
     ):
         n_dialog_messages_before = len(dialog_messages)
         answer = None
-        
+
+        if image_buffer is not None:
+            encoded_image = await asyncio.to_thread(self._encode_image, image_buffer)
+            image_url = f"data:image/jpeg;base64,{encoded_image}"
+
         while answer is None:
             try:
                 messages = self._generate_prompt_messages(
-                    message, dialog_messages, chat_mode, image_buffer
+                    message, dialog_messages, chat_mode, image_url
                 )
                 
+                encoding = _get_encoding(self.model)
+                n_input_tokens = self._count_input_tokens(messages, model=self.model)
+                n_output_tokens = 1
+
                 stream = await client.chat.completions.create(
                     model=self.model,
                     messages=messages,
@@ -184,56 +267,54 @@ class ChatGPT:
                 )
 
                 answer = ""
+                # str += o'rniga fragmentlar ro'yxati — join faqat yield paytida
+                answer_parts = []
+                last_yield = time.monotonic()
+                pending_len = 0
                 async for chunk in stream:
-                    if chunk.choices[0].delta.content:
-                        answer += chunk.choices[0].delta.content
-                        n_input_tokens, n_output_tokens = self._count_tokens_from_messages(
-                            messages, answer, model=self.model
-                        )
+                    delta = chunk.choices[0].delta.content
+                    if delta:
+                        answer_parts.append(delta)
+                        n_output_tokens += len(encoding.encode_ordinary(delta))
+                        # mayda deltalarni jamlaymiz — iste'molchi har 1-3 belgida uyg'onmasin
+                        pending_len += len(delta)
+                        if pending_len < 40 and time.monotonic() - last_yield < 0.05:
+                            continue
+                        answer = "".join(answer_parts)
                         n_first_dialog_messages_removed = n_dialog_messages_before - len(dialog_messages)
                         yield "not_finished", answer, (n_input_tokens, n_output_tokens), n_first_dialog_messages_removed
+                        pending_len = 0
+                        last_yield = time.monotonic()
 
-                answer = self._postprocess_answer(answer)
+                answer = self._postprocess_answer("".join(answer_parts))
 
             except Exception as e:
                 error_str = str(e)
                 if "maximum context length" in error_str or "context_length_exceeded" in error_str:
                     if len(dialog_messages) == 0:
                         raise
-                    dialog_messages = dialog_messages[1:]
+                    self._drop_oldest_to_fit(dialog_messages, messages)
                 else:
                     raise
 
+        n_first_dialog_messages_removed = n_dialog_messages_before - len(dialog_messages)
         yield "finished", answer, (n_input_tokens, n_output_tokens), n_first_dialog_messages_removed
 
     def _encode_image(self, image_buffer: BytesIO) -> str:
-        image_buffer.seek(0)
-        encoded = base64.b64encode(image_buffer.read()).decode("utf-8")
-        image_buffer.seek(0)
-        return encoded
+        # getbuffer() nusxa olmaydi; base64 7-bitli bo'lgani uchun ascii decode yetarli
+        return base64.b64encode(image_buffer.getbuffer()).decode("ascii")
 
-    def _generate_prompt_messages(self, message, dialog_messages, chat_mode, image_buffer: BytesIO = None):
-        prompt = config.chat_modes[chat_mode]["prompt_start"]
+    def _generate_prompt_messages(self, message, dialog_messages, chat_mode, image_url: str = None):
+        prompt = config.chat_modes[chat_mode].prompt_start
         messages = [{"role": "system", "content": prompt}]
-        
+
         for dialog_message in dialog_messages:
-            if isinstance(dialog_message["user"], str):
-                user_content = dialog_message["user"]
-            elif isinstance(dialog_message["user"], list):
-                user_content = ""
-                for item in dialog_message["user"]:
-                    if item.get("type") == "text":
-                        user_content = item.get("text", "")
-                        break
-                if not user_content:
-                    user_content = "[Image message]"
-            else:
-                user_content = str(dialog_message["user"])
-                
-            messages.append({"role": "user", "content": user_content})
-            messages.append({"role": "assistant", "content": dialog_message["bot"]})
-                        
-        if image_buffer is not None:
+            messages.extend((
+                {"role": "user", "content": _extract_user_text(dialog_message["user"])},
+                {"role": "assistant", "content": dialog_message["bot"]},
+            ))
+
+        if image_url is not None:
             messages.append({
                 "role": "user", 
                 "content": [
@@ -241,7 +322,7 @@ class ChatGPT:
                     {
                         "type": "image_url",
                         "image_url": {
-                            "url": f"data:image/jpeg;base64,{self._encode_image(image_buffer)}",
+                            "url": image_url,
                             "detail": "high"
                         }
                     }
@@ -256,14 +337,11 @@ class ChatGPT:
         answer = answer.strip()
         return answer
 
-    def _count_tokens_from_messages(self, messages, answer, model="gpt-3.5-turbo"):
-        if model.startswith("gpt-5"):
-            encoding = tiktoken.get_encoding("cl100k_base")
-        else:
-            encoding = tiktoken.encoding_for_model(model)
+    def _count_input_tokens(self, messages, model="gpt-3.5-turbo"):
+        """Prompt tokenlarini hisoblash — streaming'da bir marta, chunk'larda emas"""
+        encoding = _get_encoding(model)
 
         tokens_per_message = 3
-        tokens_per_name = 1
 
         n_input_tokens = 0
         for message in messages:
@@ -274,23 +352,47 @@ class ChatGPT:
             if isinstance(content, list):
                 for sub_message in content:
                     if sub_message.get("type") == "text":
-                        n_input_tokens += len(encoding.encode(sub_message.get("text", "")))
+                        n_input_tokens += len(encoding.encode_ordinary(sub_message.get("text", "")))
                     elif sub_message.get("type") == "image_url":
                         detail = sub_message.get("image_url", {}).get("detail", "low")
                         n_input_tokens += 765 if detail == "high" else 85
             elif isinstance(content, str):
-                n_input_tokens += len(encoding.encode(content))
+                n_input_tokens += len(encoding.encode_ordinary(content))
 
         n_input_tokens += 2
-        n_output_tokens = 1 + len(encoding.encode(answer))
-
-        return n_input_tokens, n_output_tokens
+        return n_input_tokens
+
+    def _drop_oldest_to_fit(self, dialog_messages, messages):
+        """Kontekst xatosida ortiqchani bitta lokal hisob bilan bo'shatish
+
+        Har muvaffaqiyatsiz urinishda bittadan o'chirish o'rniga qancha eski
+        xabar ketishi kerakligi tiktoken bilan taxmin qilinadi — API'ga
+        behuda qayta urilmaymiz.
+        """
+        encoding = _get_encoding(self.model)
+        limit = MODEL_CONTEXT.get(self.model, 8_192)
+        # javob va taxmin xatoligi uchun zaxira
+        budget = max(limit - 4_096, 1_024)
+        excess = self._count_input_tokens(messages, model=self.model) - budget
+
+        n_drop = 0
+        for dm in dialog_messages:
+            if excess <= 0:
+                break
+            user = dm["user"]
+            if not isinstance(user, str):
+                user = str(user)
+            excess -= len(encoding.encode_ordinary(user)) + len(encoding.encode_ordinary(dm["bot"] or "")) + 6
+            n_drop += 1
+
+        # server "uzun" dedi — kamida bitta xabar ketishi shart
+        del dialog_messages[:max(n_drop, 1)]
 
     def _count_tokens_from_prompt(self, prompt, answer, model="davinci"):
-        encoding = tiktoken.encoding_for_model("cl100k_base" if model.startswith("gpt-5") else model)
+        encoding = _get_encoding(model)
 
-        n_input_tokens = len(encoding.encode(prompt)) + 1
-        n_output_tokens = len(encoding.encode(answer))
+        n_input_tokens = len(encoding.encode_ordinary(prompt)) + 1
+        n_output_tokens = len(encoding.encode_ordinary(answer))
 
         return n_input_tokens, n_output_tokens
 
@@ -309,7 +411,9 @@ async def transcribe_audio(audio_file) -> str:
 
 
 async def generate_dalle_prompt(image_buffer, user_instruction):
-    base64_image = base64.b64encode(image_buffer.getvalue()).decode('utf-8')
+    base64_image = await asyncio.to_thread(
+        lambda: base64.b64encode(image_buffer.getbuffer()).decode('utf-8')
+    )
     
     messages = [
         {